@@ -1,146 +1,412 @@
-from datetime import datetime, timedelta
+import time
+from typing import Callable, cast
 
 import commands
 import data_types
 from logs import logger
 
+# RESP type bytes, compared as ints to avoid slicing
+_ARRAY_TYPE = ord("*")
+_BULK_STRING_TYPE = ord("$")
+_SIMPLE_STRING_TYPE = ord("+")
+_BULK_STRING_TAG = data_types.RespBulkString._tag
+
+
+# replicas and health checks send the same few buffers over and over, so keep a
+# small direct mapped cache of buffer -> commands. a colliding buffer simply
+# replaces the slot, so the cache never grows
+_PARSE_CACHE_SIZE = 64  # must be a power of 2
+_PARSE_CACHE_MAX_LEN = 128
+_parse_cache: list[tuple[bytes, tuple[commands.Command, ...]] | None] = [
+    None
+] * _PARSE_CACHE_SIZE
+# only commands that carry no state beyond their raw bytes can be shared
+_CACHEABLE_CMDS = frozenset(
+    (
+        commands.PingCommand,
+        commands.CommandCommand,
+        commands.InfoCommand,
+        commands.ReplConfCommand,
+        commands.ReplConfAckCommand,
+        commands.ReplConfGetAckCommand,
+    )
+)
+
 
 def parse_cmd(cmd: bytes) -> list[commands.Command]:
+    if len(cmd) > _PARSE_CACHE_MAX_LEN:
+        return parse_cmd_uncached(cmd)
+    slot = hash(cmd) & (_PARSE_CACHE_SIZE - 1)
+    cached = _parse_cache[slot]
+    if cached is not None and cached[0] == cmd:
+        return list(cached[1])
+    final_cmds = parse_cmd_uncached(cmd)
+    if all(type(c) in _CACHEABLE_CMDS for c in final_cmds):
+        _parse_cache[slot] = (cmd, tuple(final_cmds))
+    return final_cmds
+
+
+def parse_cmd_uncached(cmd: bytes) -> list[commands.Command]:
     final_cmds: list[commands.Command] = []
+    # commands keep a view of their frame rather than a copy, sockets and len()
+    # accept memoryviews directly
+    view = memoryview(cmd)
+    # find every separator up front so decoders jump between them instead of
+    # scanning byte by byte, which matters for pipelined buffers
+    seps = data_types.SepIndex(cmd)
     pos = 0
     while pos < len(cmd):
         orig = pos
-        resp_data, pos = dispatch(cmd, pos)
-        logger.info(f"Codec.parse {resp_data=}, {pos=}")
-        if isinstance(resp_data, data_types.RespArray):
-            final_cmds.append(parse_resp_cmd(resp_data, cmd, orig, pos))
-        elif isinstance(resp_data, data_types.RespSimpleString):
+        data_type = cmd[pos]
+        if data_type == _ARRAY_TYPE:
+            resp_array, pos = data_types.RespArray.decode(cmd, pos, seps)
+            logger.info("Codec.parse resp_array=%r, pos=%d", resp_array, pos)
+            final_cmds.append(parse_resp_cmd(resp_array, view, orig, pos))
+        elif data_type == _SIMPLE_STRING_TYPE:
             # is +FULLRESYNC
-            final_cmds.append(commands.FullResyncCommand(resp_data.data))
-        elif isinstance(resp_data, data_types.RespRdbFile):
-            final_cmds.append(commands.RdbFileCommand(resp_data.data.data))
+            simple_str, pos = data_types.RespSimpleString.decode(cmd, pos, seps)
+            logger.info("Codec.parse simple_str=%r, pos=%d", simple_str, pos)
+            final_cmds.append(commands.FullResyncCommand(simple_str.data))
+        elif data_type == _BULK_STRING_TYPE:
+            resp_data, pos = data_types.decode_bulk_string_or_rdb(cmd, pos, seps)
+            logger.info("Codec.parse resp_data=%r, pos=%d", resp_data, pos)
+            if type(resp_data) is data_types.RespRdbFile:
+                final_cmds.append(commands.RdbFileCommand(resp_data.data.data))
+            else:
+                logger.error(
+                    f"Unsupported command (is not array) {resp_data}, {type(resp_data)}"
+                )
+                final_cmds.append(commands.NoOp(view[orig:pos]))
         else:
-            logger.error(
-                f"Unsupported command (is not array) {resp_data}, {type(resp_data)}"
+            logger.info(
+                f"Raising exception: Unsupported data type {cmd[pos:pos + 1]!r}"
             )
-            final_cmds.append(commands.NoOp(cmd[orig:pos]))
+            raise Exception(f"Unsupported data type {cmd[pos:pos + 1]!r}")
     return final_cmds
 
 
+class StreamParser:
+    # frames commands out of a byte stream that can split them anywhere, like
+    # the replication link. bytes after the last complete frame are kept for
+    # the next feed, and need is the buffer length below which the pending
+    # frame can't be complete, so a big payload arriving over many reads isn't
+    # rescanned on each one
+    __slots__ = ("buf", "need")
+
+    def __init__(self):
+        self.buf = bytearray()
+        self.need = 0
+
+    def feed(self, data: bytes | bytearray | memoryview) -> list[commands.Command]:
+        buf = self.buf
+        buf += data
+        if len(buf) < self.need:
+            return []
+        end = 0
+        while True:
+            frame_end = _frame_end(buf, end)
+            if frame_end < 0:
+                self.need = -frame_end
+                break
+            end = frame_end
+        if end == 0:
+            return []
+        frame = bytes(buf[:end])
+        del buf[:end]
+        self.need -= end
+        return parse_cmd(frame)
+
+
+def _frame_end(buf: bytearray, pos: int) -> int:
+    # returns the end of the frame starting at pos, or if it isn't all there
+    # yet, minus the buffer length needed before it might be
+    n = len(buf)
+    if pos >= n:
+        return -(pos + 1)
+    line_end = buf.find(b"\r\n", pos)
+    if line_end == -1:
+        return -(n + 1)
+    data_type = buf[pos]
+    if data_type == _ARRAY_TYPE:
+        count = int(buf[pos + 1 : line_end])
+        pos = line_end + 2
+        for _ in range(count):
+            pos = _frame_end(buf, pos)
+            if pos < 0:
+                return pos
+        return pos
+    if data_type == _BULK_STRING_TYPE:
+        length = int(buf[pos + 1 : line_end])
+        pos = line_end + 2
+        if length < 0:
+            return pos
+        end = pos + length
+        # bulk strings end with a separator and RDB files don't, so wait until
+        # the two bytes after the payload are in to tell them apart
+        if n < end + 2:
+            return -(end + 2)
+        return end + 2 if buf[end : end + 2] == b"\r\n" else end
+    # simple strings, errors and integers are a single line. anything else is
+    # left for parse_cmd to reject
+    return line_end + 2
+
+
 def parse_resp_cmd(
-    resp_data: data_types.RespArray, cmd: bytes, start: int, end: int
+    resp_data: data_types.RespArray, cmd: bytes | memoryview, start: int, end: int
 ) -> commands.Command:
     resp_elements: list[data_types.RespBulkString] = []
     for element in resp_data.elements:
-        result = data_types.RespBulkString.safe_validate(element)
-        if result[1] is not None:
+        if element._tag != _BULK_STRING_TAG:
             logger.error(
-                f"Unsupported command {cmd[start:end]}, {element} is not a bulk string"
+                f"Unsupported command {bytes(cmd[start:end])!r}, {element} is not a bulk string"
             )
             return commands.NoOp(cmd[start:end])
-        resp_elements.append(result[0])
+        resp_elements.append(cast(data_types.RespBulkString, element))
 
-    cmd_str = resp_elements[0].data.upper()
+    # clients almost always send all upper or all lower case, so only fall back
+    # to allocating an upper cased copy for mixed case names
+    cmd_str = resp_elements[0].data
     raw_cmd = cmd[start:end]
-    if cmd_str == b"PING":
-        return commands.PingCommand(raw_cmd)
-    elif cmd_str == b"ECHO":
-        msg = resp_elements[1]
-        return commands.EchoCommand(raw_cmd, msg)
-    elif cmd_str == b"SET":
-        key = resp_elements[1]
-        value = resp_elements[2]
-        if len(resp_data) <= 3:
-            return commands.SetCommand(raw_cmd, key, value, None)
-        px_cmd = resp_elements[3]
-        expiry = resp_elements[4]
-        commands.SetCommand.validate_px(px_cmd)
-        return commands.SetCommand(
-            raw_cmd,
-            key,
-            value,
-            datetime.now() + timedelta(milliseconds=int(expiry.data)),
+    builder = _CMD_DISPATCH.get(cmd_str)
+    if builder is None:
+        builder = _CMD_DISPATCH.get(cmd_str.upper())
+    if builder is None:
+        return commands.RdbFileCommand(raw_cmd)
+    return builder(raw_cmd, resp_elements, resp_data)
+
+
+def _build_ping(
+    raw_cmd: bytes | memoryview,
+    resp_elements: list[data_types.RespBulkString],
+    resp_data: data_types.RespArray,
+) -> commands.Command:
+    shared = _SHARED_CMDS.get(raw_cmd)
+    if shared is not None:
+        return shared
+    return commands.PingCommand(raw_cmd)
+
+
+def _build_get(
+    raw_cmd: bytes | memoryview,
+    resp_elements: list[data_types.RespBulkString],
+    resp_data: data_types.RespArray,
+) -> commands.Command:
+    key = resp_elements[1]
+    return commands.GetCommand(raw_cmd, key)
+
+
+def _build_set(
+    raw_cmd: bytes | memoryview,
+    resp_elements: list[data_types.RespBulkString],
+    resp_data: data_types.RespArray,
+) -> commands.Command:
+    key = resp_elements[1]
+    value = resp_elements[2]
+    if len(resp_data) <= 3:
+        return commands.SetCommand(raw_cmd, key, value, None)
+    px_cmd = resp_elements[3]
+    expiry = resp_elements[4]
+    commands.SetCommand.validate_px(px_cmd)
+    return commands.SetCommand(
+        raw_cmd,
+        key,
+        value,
+        time.time_ns() // 1_000_000 + int(expiry.data),
+    )
+
+
+def _build_echo(
+    raw_cmd: bytes | memoryview,
+    resp_elements: list[data_types.RespBulkString],
+    resp_data: data_types.RespArray,
+) -> commands.Command:
+    msg = resp_elements[1]
+    return commands.EchoCommand(raw_cmd, msg)
+
+
+def _build_command(
+    raw_cmd: bytes | memoryview,
+    resp_elements: list[data_types.RespBulkString],
+    resp_data: data_types.RespArray,
+) -> commands.Command:
+    shared = _SHARED_CMDS.get(raw_cmd)
+    if shared is not None:
+        return shared
+    return commands.CommandCommand(raw_cmd)
+
+
+def _build_info(
+    raw_cmd: bytes | memoryview,
+    resp_elements: list[data_types.RespBulkString],
+    resp_data: data_types.RespArray,
+) -> commands.Command:
+    # should check for next word, but only replication is supported
+    shared = _SHARED_CMDS.get(raw_cmd)
+    if shared is not None:
+        return shared
+    return commands.InfoCommand(raw_cmd)
+
+
+def _build_replconf(
+    raw_cmd: bytes | memoryview,
+    resp_elements: list[data_types.RespBulkString],
+    resp_data: data_types.RespArray,
+) -> commands.Command:
+    if len(resp_data) >= 3:
+        cmd_str2 = resp_elements[1].data
+        sub_cmd = _REPLCONF_SUB_DISPATCH.get(cmd_str2) or _REPLCONF_SUB_DISPATCH.get(
+            cmd_str2.upper()
         )
-    elif cmd_str == b"GET":
-        key = resp_elements[1]
-        return commands.GetCommand(raw_cmd, key)
-    elif cmd_str == b"COMMAND":
-        return commands.CommandCommand(raw_cmd)
-    elif cmd_str == b"INFO":
-        # should check for next word, but only replication is supported
-        return commands.InfoCommand(raw_cmd)
-    elif cmd_str == b"REPLCONF":
-        if len(resp_data) >= 3:
-            cmd_str2 = resp_elements[1]
-            if cmd_str2.data.upper() == b"GETACK":
-                return commands.ReplConfGetAckCommand(raw_cmd)
-            elif cmd_str2.data.upper() == b"ACK":
-                return commands.ReplConfAckCommand(raw_cmd)
-        return commands.ReplConfCommand(raw_cmd)
-    elif cmd_str == b"WAIT":
-        replica_count = resp_elements[1]
+        if sub_cmd is not None:
+            shared = _SHARED_CMDS.get(raw_cmd)
+            if shared is not None:
+                return shared
+            return sub_cmd(raw_cmd)
+    return commands.ReplConfCommand(raw_cmd)
+
+
+_REPLCONF_SUB_DISPATCH: dict[
+    bytes, Callable[[bytes | memoryview], commands.Command]
+] = {
+    b"GETACK": commands.ReplConfGetAckCommand,
+    b"ACK": commands.ReplConfAckCommand,
+}
+
+
+def _build_wait(
+    raw_cmd: bytes | memoryview,
+    resp_elements: list[data_types.RespBulkString],
+    resp_data: data_types.RespArray,
+) -> commands.Command:
+    replica_count = resp_elements[1]
+    timeout = resp_elements[2]
+    return commands.WaitCommand(raw_cmd, int(replica_count.data), int(timeout.data))
+
+
+def _build_psync(
+    raw_cmd: bytes | memoryview,
+    resp_elements: list[data_types.RespBulkString],
+    resp_data: data_types.RespArray,
+) -> commands.Command:
+    return commands.PsyncCommand(raw_cmd)
+
+
+def _build_config(
+    raw_cmd: bytes | memoryview,
+    resp_elements: list[data_types.RespBulkString],
+    resp_data: data_types.RespArray,
+) -> commands.Command:
+    key = resp_elements[2]
+    return commands.ConfigGetCommand(raw_cmd, key.data)
+
+
+def _build_keys(
+    raw_cmd: bytes | memoryview,
+    resp_elements: list[data_types.RespBulkString],
+    resp_data: data_types.RespArray,
+) -> commands.Command:
+    pattern = resp_elements[1]
+    return commands.KeysCommand(raw_cmd, pattern.data)
+
+
+def _build_type(
+    raw_cmd: bytes | memoryview,
+    resp_elements: list[data_types.RespBulkString],
+    resp_data: data_types.RespArray,
+) -> commands.Command:
+    key = resp_elements[1]
+    return commands.TypeCommand(raw_cmd, key.data)
+
+
+def _build_xadd(
+    raw_cmd: bytes | memoryview,
+    resp_elements: list[data_types.RespBulkString],
+    resp_data: data_types.RespArray,
+) -> commands.Command:
+    stream_key = resp_elements[1]
+    return commands.XaddCommand(raw_cmd, stream_key.data, resp_elements[2:])
+
+
+def _build_xrange(
+    raw_cmd: bytes | memoryview,
+    resp_elements: list[data_types.RespBulkString],
+    resp_data: data_types.RespArray,
+) -> commands.Command:
+    key = resp_elements[1]
+    xrange_start = resp_elements[2]
+    xrange_end = resp_elements[3]
+    return commands.XrangeCommand(
+        raw_cmd,
+        key.data,
+        xrange_start.data.decode(),
+        xrange_end.data.decode(),
+    )
+
+
+def _build_xread(
+    raw_cmd: bytes | memoryview,
+    resp_elements: list[data_types.RespBulkString],
+    resp_data: data_types.RespArray,
+) -> commands.Command:
+    # first argument should be "streams"
+    streams = resp_elements[1]
+    key_id_start_idx = 2
+    is_block = False
+    if streams.data.upper() == b"BLOCK":
+        is_block = True
+        key_id_start_idx = 4
+    # keys and ids are the two halves of the remaining elements
+    half = (len(resp_elements) - key_id_start_idx) // 2
+    keys: list[str] = [""] * half
+    ids: list[str] = [""] * half
+    for i in range(half):
+        keys[i] = commands.decode_key(resp_elements[key_id_start_idx + i].data)
+        ids[i] = resp_elements[key_id_start_idx + half + i].data.decode()
+    if is_block:
         timeout = resp_elements[2]
-        return commands.WaitCommand(raw_cmd, int(replica_count.data), int(timeout.data))
-    elif cmd_str == b"PSYNC":
-        return commands.PsyncCommand(raw_cmd)
-    elif cmd_str == b"CONFIG":
-        key = resp_elements[2]
-        return commands.ConfigGetCommand(raw_cmd, key.data)
-    elif cmd_str == b"KEYS":
-        pattern = resp_elements[1]
-        return commands.KeysCommand(raw_cmd, pattern.data)
-    elif cmd_str == b"TYPE":
-        key = resp_elements[1]
-        return commands.TypeCommand(raw_cmd, key.data)
-    elif cmd_str == b"XADD":
-        stream_key = resp_elements[1]
-        return commands.XaddCommand(raw_cmd, stream_key.data, resp_elements[2:])
-    elif cmd_str == b"XRANGE":
-        key = resp_elements[1]
-        xrange_start = resp_elements[2]
-        xrange_end = resp_elements[3]
-        return commands.XrangeCommand(
-            raw_cmd,
-            key.data,
-            xrange_start.data.decode(),
-            xrange_end.data.decode(),
-        )
-    elif cmd_str == b"XREAD":
-        # first argument should be "streams"
-        streams = resp_elements[1]
-        key_id_start_idx = 2
-        is_block = False
-        if streams.data.upper() == b"BLOCK":
-            is_block = True
-            key_id_start_idx = 4
-        remaining_len = len(resp_data) - key_id_start_idx
-        keys = [
-            k.data.decode()
-            for k in resp_elements[
-                key_id_start_idx : key_id_start_idx + remaining_len // 2
-            ]
-        ]
-        ids = [
-            i.data.decode()
-            for i in resp_elements[key_id_start_idx + remaining_len // 2 :]
-        ]
-        if is_block:
-            timeout = resp_elements[2]
-            return commands.XreadCommand(raw_cmd, keys, ids, int(timeout.data.decode()))
-        else:
-            return commands.XreadCommand(raw_cmd, keys, ids)
+        return commands.XreadCommand(raw_cmd, keys, ids, int(timeout.data.decode()))
     else:
-        return commands.RdbFileCommand(raw_cmd)
+        return commands.XreadCommand(raw_cmd, keys, ids)
 
 
-def dispatch(cmd: bytes, pos: int) -> tuple[data_types.RespDataType, int]:
-    data_type = cmd[pos : pos + 1]
-    if data_type == b"*":
-        return data_types.RespArray.decode(cmd, pos)
-    elif data_type == b"$":
-        return data_types.decode_bulk_string_or_rdb(cmd, pos)
-    elif data_type == b"+":
-        return data_types.RespSimpleString.decode(cmd, pos)
-    else:
-        logger.info(f"Raising exception: Unsupported data type {data_type}")
-        raise Exception(f"Unsupported data type {data_type}")
+# stateless commands are shared when their raw bytes match the usual encoding.
+# raw_cmd still has to be exact since replicas count it towards their offset
+_SHARED_CMDS: dict[bytes | memoryview, commands.Command] = {
+    shared.raw_cmd: shared
+    for shared in (
+        commands.PingCommand(commands.craft_command("PING").encode()),
+        commands.CommandCommand(commands.craft_command("COMMAND").encode()),
+        commands.InfoCommand(commands.craft_command("INFO").encode()),
+        commands.InfoCommand(commands.craft_command("INFO", "replication").encode()),
+        commands.ReplConfGetAckCommand(
+            commands.craft_command("REPLCONF", "GETACK", "*").encode()
+        ),
+    )
+}
+
+# hot commands first
+_CMD_DISPATCH: dict[
+    bytes,
+    Callable[
+        [bytes | memoryview, list[data_types.RespBulkString], data_types.RespArray],
+        commands.Command,
+    ],
+] = {
+    b"PING": _build_ping,
+    b"GET": _build_get,
+    b"SET": _build_set,
+    b"ECHO": _build_echo,
+    b"COMMAND": _build_command,
+    b"INFO": _build_info,
+    b"REPLCONF": _build_replconf,
+    b"WAIT": _build_wait,
+    b"PSYNC": _build_psync,
+    b"CONFIG": _build_config,
+    b"KEYS": _build_keys,
+    b"TYPE": _build_type,
+    b"XADD": _build_xadd,
+    b"XRANGE": _build_xrange,
+    b"XREAD": _build_xread,
+}
+_CMD_DISPATCH.update({k.lower(): v for k, v in _CMD_DISPATCH.items()})
+
@@ -1,44 +1,66 @@
-from abc import ABC, abstractmethod
-from datetime import datetime
 import socket
 from datetime import timedelta
+import time
 
 import constants
 import data_types
 import database
 import exceptions
 from logs import logger
+import rdb
 import replicas
+import replies
 
+# responses that never change, encoded once at import
+_FULLRESYNC_PREFIX = b"+FULLRESYNC "
+
+_KEY_CACHE_SIZE = 2048
+_KEY_CACHE_MAX_LEN = 64
+_key_cache: dict[bytes, str] = {}
+
+# wire formats for requests with a fixed shape, filled in with % formatting
+_PING_WIRE = b"*1\r\n$4\r\nPING\r\n"
+_GETACK_WIRE = b"*3\r\n$8\r\nREPLCONF\r\n$6\r\nGETACK\r\n$1\r\n*\r\n"
+_ACK_WIRE = b"*3\r\n$8\r\nREPLCONF\r\n$3\r\nACK\r\n$%d\r\n%b\r\n"
+_ECHO_WIRE = b"*2\r\n$4\r\nECHO\r\n$%d\r\n%b\r\n"
+_GET_WIRE = b"*2\r\n$3\r\nGET\r\n$%d\r\n%b\r\n"
+_SET_WIRE = b"*3\r\n$3\r\nSET\r\n$%d\r\n%b\r\n$%d\r\n%b\r\n"
+_SET_PX_WIRE = b"*5\r\n$3\r\nSET\r\n$%d\r\n%b\r\n$%d\r\n%b\r\n$2\r\nPX\r\n$%d\r\n%b\r\n"
+
+
+# plain base class with __slots__ rather than an ABC, so commands carry no __dict__
+class Command:
+    __slots__ = ("_raw_cmd",)
 
-class Command(ABC):
     def __init__(self):
         self._raw_cmd = b""
 
     @property
-    def raw_cmd(self) -> bytes:
+    def raw_cmd(self) -> bytes | memoryview:
         return self._raw_cmd
 
-    @abstractmethod
     def execute(
         self,
         db: database.Database | None,
         replica_handler: replicas.ReplicaHandler | None,
         conn: socket.socket | None,
-    ) -> bytes | list[bytes]: ...
+    ) -> bytes | list[bytes]:
+        raise NotImplementedError
 
     @staticmethod
-    @abstractmethod
     # might raise RequestCraftError
-    def craft_request(*args: str) -> "Command": ...
+    def craft_request(*args: str) -> "Command":
+        raise NotImplementedError
 
 
 class NoOp(Command):
-    def __init__(self, raw_cmd: bytes):
+    __slots__ = ()
+
+    def __init__(self, raw_cmd: bytes | memoryview):
         self._raw_cmd = raw_cmd
 
     def execute(self, db, replica_handler, conn) -> bytes:
-        return data_types.RespSimpleError(constants.NO_OP_RESPONSE.encode()).encode()
+        return replies.NOOP_ERR
 
     @staticmethod
     def craft_request(*args: str) -> "NoOp":
@@ -46,54 +68,60 @@ class NoOp(Command):
 
 
 class PingCommand(Command):
-    def __init__(self, raw_cmd: bytes):
+    __slots__ = ()
+
+    def __init__(self, raw_cmd: bytes | memoryview):
         self._raw_cmd = raw_cmd
 
     def execute(self, db, replica_handler, conn) -> bytes:
-        return data_types.RespSimpleString(b"PONG").encode()
+        return replies.PONG
 
     @staticmethod
     def craft_request(*args: str) -> "PingCommand":
-        return PingCommand(craft_command("PING").encode())
+        return PingCommand(_PING_WIRE)
 
 
 class EchoCommand(Command):
-    def __init__(self, raw_cmd: bytes, bulk_str: data_types.RespBulkString):
+    __slots__ = ("msg",)
+
+    def __init__(
+        self, raw_cmd: bytes | memoryview, bulk_str: data_types.RespBulkString
+    ):
         self._raw_cmd = raw_cmd
         self.msg = bulk_str.data
 
     def execute(self, db, replica_handler, conn) -> bytes:
-        return data_types.RespSimpleString(self.msg).encode()
+        return replies.simple(self.msg)
 
     @staticmethod
     def craft_request(*args: str) -> "EchoCommand":
         if len(args) > 1:
             raise exceptions.RequestCraftError("EchoCommand takes up to 1 argument")
-        return EchoCommand(
-            craft_command("ECHO", *args).encode(),
-            data_types.RespBulkString(args[0].encode()),
-        )
+        msg = args[0].encode()
+        return EchoCommand(_ECHO_WIRE % (len(msg), msg), data_types.RespBulkString(msg))
 
 
 class SetCommand(Command):
+    __slots__ = ("key_str", "value_str", "expiry")
+
     def __init__(
         self,
-        raw_cmd: bytes,
+        raw_cmd: bytes | memoryview,
         key: data_types.RespBulkString,
         value: data_types.RespBulkString,
-        expiry: datetime | None,
+        expiry: int | None,
     ):
         self._raw_cmd = raw_cmd
-        self.key = key.data
-        self.value = value.data
+        self.key_str = decode_key(key.data)
+        self.value_str = value.data.decode()
         self.expiry = expiry
 
     def execute(
         self, db: database.Database, replica_handler: replicas.ReplicaHandler, conn
     ) -> bytes:
         replica_handler.propogate(self._raw_cmd)
-        db[self.key.decode()] = (self.value.decode(), self.expiry)
-        return constants.OK_SIMPLE_RESP_STRING.encode()
+        db[self.key_str] = (self.value_str, self.expiry)
+        return replies.OK
 
     @staticmethod
     def validate_px(px_cmd: data_types.RespBulkString):
@@ -106,48 +134,58 @@ class SetCommand(Command):
     def craft_request(*args: str) -> "SetCommand":
         if len(args) != 2 and len(args) != 3:
             raise exceptions.RequestCraftError("SetCommand takes 2 or 3 arguments")
+        key = args[0].encode()
+        value = args[1].encode()
         if len(args) == 2:
             expiry = None
+            raw_cmd = _SET_WIRE % (len(key), key, len(value), value)
         else:
-            expiry = datetime.now() + timedelta(milliseconds=int(args[2]))
+            expiry = time.time_ns() // 1_000_000 + int(args[2])
+            px = args[2].encode()
+            raw_cmd = _SET_PX_WIRE % (len(key), key, len(value), value, len(px), px)
         return SetCommand(
-            craft_command("SET", *args).encode(),
-            data_types.RespBulkString(args[0].encode()),
-            data_types.RespBulkString(args[1].encode()),
+            raw_cmd,
+            data_types.RespBulkString(key),
+            data_types.RespBulkString(value),
             expiry,
         )
 
 
 class GetCommand(Command):
-    def __init__(self, raw_cmd: bytes, key: data_types.RespBulkString):
+    __slots__ = ("key_str",)
+
+    def __init__(self, raw_cmd: bytes | memoryview, key: data_types.RespBulkString):
         self._raw_cmd = raw_cmd
-        self.key = key.data
+        self.key_str = decode_key(key.data)
 
     def execute(self, db: database.Database, replica_handler, conn) -> bytes:
-        if self.key.decode() in db:
-            value = db[self.key.decode()]
-            if isinstance(value, str):
-                return data_types.RespBulkString(value.encode()).encode()
-            elif isinstance(value, list):
-                return data_types.RespBulkString(str(value).encode()).encode()
-        return constants.NULL_BULK_RESP_STRING.encode()
+        # db returns None for missing or expired keys
+        value = db[self.key_str]
+        if isinstance(value, str):
+            return replies.bulk(value.encode())
+        elif isinstance(value, database.Stream):
+            # streams are encoded the same way as XRANGE entries
+            out = bytearray()
+            db.write_stream_entries(out, value)
+            return bytes(out)
+        return replies.NULL_BULK
 
     @staticmethod
     def craft_request(*args: str) -> "GetCommand":
         if len(args) != 1:
             raise exceptions.RequestCraftError("GetCommand takes 1 argument")
-        return GetCommand(
-            craft_command("GET", *args).encode(),
-            data_types.RespBulkString(args[0].encode()),
-        )
+        key = args[0].encode()
+        return GetCommand(_GET_WIRE % (len(key), key), data_types.RespBulkString(key))
 
 
 class CommandCommand(Command):
-    def __init__(self, raw_cmd: bytes):
+    __slots__ = ()
+
+    def __init__(self, raw_cmd: bytes | memoryview):
         self._raw_cmd = raw_cmd
 
     def execute(self, db, replica_handler, conn) -> bytes:
-        return constants.OK_SIMPLE_RESP_STRING.encode()
+        return replies.OK
 
     @staticmethod
     def craft_request(*args: str) -> "CommandCommand":
@@ -155,7 +193,9 @@ class CommandCommand(Command):
 
 
 class InfoCommand(Command):
-    def __init__(self, raw_cmd: bytes):
+    __slots__ = ()
+
+    def __init__(self, raw_cmd: bytes | memoryview):
         self._raw_cmd = raw_cmd
 
     def execute(self, db, replica_handler: replicas.ReplicaHandler, conn) -> bytes:
@@ -167,11 +207,13 @@ class InfoCommand(Command):
 
 
 class ReplConfCommand(Command):
-    def __init__(self, raw_cmd: bytes):
+    __slots__ = ()
+
+    def __init__(self, raw_cmd: bytes | memoryview):
         self._raw_cmd = raw_cmd
 
     def execute(self, db, replica_handler, conn) -> bytes:
-        return constants.OK_SIMPLE_RESP_STRING.encode()
+        return replies.OK
 
     @staticmethod
     def craft_request(*args: str) -> "ReplConfCommand":
@@ -179,14 +221,20 @@ class ReplConfCommand(Command):
 
 
 class ReplConfAckCommand(Command):
-    def __init__(self, raw_cmd: bytes):
+    __slots__ = ()
+
+    def __init__(self, raw_cmd: bytes | memoryview):
         self._raw_cmd = raw_cmd
 
     def execute(self, db, replica_handler: replicas.ReplicaHandler, conn) -> bytes:
-        logger.info(
-            f"incrementing {replica_handler.ack_count=} to {replica_handler.ack_count + 1}"
-        )
-        replica_handler.ack_count += 1
+        with replica_handler.ack_cond:
+            logger.info(
+                "incrementing replica_handler.ack_count=%d to %d",
+                replica_handler.ack_count,
+                replica_handler.ack_count + 1,
+            )
+            replica_handler.ack_count += 1
+            replica_handler.ack_cond.notify_all()
         return b""
 
     @staticmethod
@@ -197,40 +245,45 @@ class ReplConfAckCommand(Command):
 
 
 class ReplConfGetAckCommand(Command):
-    def __init__(self, raw_cmd: bytes):
+    __slots__ = ()
+
+    def __init__(self, raw_cmd: bytes | memoryview):
         self._raw_cmd = raw_cmd
 
     def execute(self, db, replica_handler: replicas.ReplicaHandler, conn) -> bytes:
         replica_handler.propogate(self._raw_cmd)
-        return data_types.RespArray(
-            [
-                data_types.RespBulkString(b"REPLCONF"),
-                data_types.RespBulkString(b"ACK"),
-                data_types.RespBulkString(
-                    str(replica_handler.master_repl_offset).encode()
-                ),
-            ]
-        ).encode()
+        # the offset is the only part that changes between acks
+        offset = data_types.itob(replica_handler.master_repl_offset)
+        return _ACK_WIRE % (len(offset), offset)
 
     @staticmethod
     def craft_request(*args: str) -> "ReplConfGetAckCommand":
-        return ReplConfGetAckCommand(craft_command("REPLCONF", "GETACK").encode())
+        return ReplConfGetAckCommand(_GETACK_WIRE)
 
 
 class PsyncCommand(Command):
-    def __init__(self, raw_cmd: bytes):
+    __slots__ = ()
+
+    def __init__(self, raw_cmd: bytes | memoryview):
         self._raw_cmd = raw_cmd
 
     def execute(
         self, db, replica_handler: replicas.ReplicaHandler, conn: socket.socket
-    ) -> list[bytes]:
-        replica_handler.add_slave(conn)
-        return [
-            data_types.RespSimpleString(
-                f"FULLRESYNC {replica_handler.ip} {replica_handler.master_repl_offset}".encode()
-            ).encode(),
-            data_types.RespRdbFile(constants.EMPTY_RDB_FILE).encode(),
-        ]
+    ) -> bytes:
+        replica_handler.add_slave(
+            conn,
+            b"".join(
+                (
+                    _FULLRESYNC_PREFIX,
+                    replica_handler.ip.encode(),
+                    b" ",
+                    str(replica_handler.master_repl_offset).encode(),
+                    b"\r\n",
+                )
+            ),
+            db.file_path,
+        )
+        return b""
 
     @staticmethod
     def craft_request(*args: str) -> "PsyncCommand":
@@ -238,6 +291,8 @@ class PsyncCommand(Command):
 
 
 class FullResyncCommand(Command):
+    __slots__ = ("data",)
+
     def __init__(self, data: bytes) -> None:
         self.data = data
         self._raw_cmd = data
@@ -251,7 +306,9 @@ class FullResyncCommand(Command):
 
 
 class RdbFileCommand(Command):
-    def __init__(self, data: bytes) -> None:
+    __slots__ = ("rdbfile",)
+
+    def __init__(self, data: rdb.RdbData) -> None:
         self.rdbfile = data_types.RespRdbFile(data)
         self._raw_cmd = data
 
@@ -265,7 +322,9 @@ class RdbFileCommand(Command):
 
 
 class ConfigGetCommand(Command):
-    def __init__(self, raw_cmd: bytes, key: bytes):
+    __slots__ = ("key",)
+
+    def __init__(self, raw_cmd: bytes | memoryview, key: bytes):
         self._raw_cmd = raw_cmd
         self.key = key
 
@@ -284,7 +343,7 @@ class ConfigGetCommand(Command):
                     data_types.RespBulkString(db.dbfilename.encode()),
                 ]
             ).encode()
-        return constants.OK_SIMPLE_RESP_STRING.encode()
+        return replies.OK
 
     @staticmethod
     def craft_request(*args: str) -> "ConfigGetCommand":
@@ -296,18 +355,15 @@ class ConfigGetCommand(Command):
 
 
 class KeysCommand(Command):
-    def __init__(self, raw_cmd: bytes, pattern: bytes):
+    __slots__ = ("pattern",)
+
+    def __init__(self, raw_cmd: bytes | memoryview, pattern: bytes):
         self._raw_cmd = raw_cmd
         self.pattern = pattern
 
     def execute(self, db: database.Database, replica_handler, conn) -> bytes:
         return data_types.RespArray(
-            list(
-                map(
-                    lambda x: data_types.RespBulkString(x.encode()),
-                    db.rdb.key_values.keys(),
-                )
-            )
+            [data_types.RespBulkString(k.encode()) for k in db.rdb.key_values.keys()]
         ).encode()
 
     @staticmethod
@@ -318,7 +374,9 @@ class KeysCommand(Command):
 
 
 class WaitCommand(Command):
-    def __init__(self, raw_cmd: bytes, replica_count: int, timeout: int):
+    __slots__ = ("replica_count", "timeout")
+
+    def __init__(self, raw_cmd: bytes | memoryview, replica_count: int, timeout: int):
         self._raw_cmd = raw_cmd
         self.replica_count = replica_count
         self.timeout = timedelta(milliseconds=timeout)
@@ -326,24 +384,23 @@ class WaitCommand(Command):
     def execute(
         self, db, replica_handler: replicas.ReplicaHandler, conn: socket.socket
     ) -> bytes:
-        now = datetime.now()
-        end = now + self.timeout
-        replica_handler.ack_count = 0
-        replica_handler.propogate(
-            data_types.RespArray(
-                [
-                    data_types.RespBulkString(b"REPLCONF"),
-                    data_types.RespBulkString(b"GETACK"),
-                    data_types.RespBulkString(b"*"),
-                ]
-            ).encode()
-        )
-        logger.info(f"finished sending to all slaves")
-        while replica_handler.ack_count < self.replica_count and datetime.now() < end:
-            pass
+        deadline = time.monotonic() + self.timeout.total_seconds()
+        with replica_handler.ack_cond:
+            replica_handler.ack_count = 0
+        replica_handler.propogate(_GETACK_WIRE)
+        # the acks can't come back until the GETACK is actually sent
+        replica_handler.flush_replicas()
+        logger.info("finished sending to all slaves")
+        with replica_handler.ack_cond:
+            replica_handler.ack_cond.wait_for(
+                lambda: replica_handler.ack_count >= self.replica_count,
+                timeout=deadline - time.monotonic(),
+            )
 
         logger.info(
-            f"{replica_handler.ack_count=}, {datetime.now() - end=} (should be positive)"
+            "replica_handler.ack_count=%d, time.monotonic() - deadline=%f (should be positive)",
+            replica_handler.ack_count,
+            time.monotonic() - deadline,
         )
         # hardcode to len(slaves) if no acks
         return data_types.RespInteger(
@@ -362,16 +419,15 @@ class WaitCommand(Command):
 
 
 class TypeCommand(Command):
-    def __init__(self, raw_cmd: bytes, key: bytes):
+    __slots__ = ("key_str",)
+
+    def __init__(self, raw_cmd: bytes | memoryview, key: bytes):
         self._raw_cmd = raw_cmd
-        self.key = key
+        self.key_str = decode_key(key)
 
     def execute(self, db: database.Database, replica_handler, conn) -> bytes:
-        if self.key.decode() in db:
-            return data_types.RespSimpleString(
-                db.get_type(self.key.decode()).encode()
-            ).encode()
-        return data_types.RespSimpleString(b"none").encode()
+        # get_type returns "none" for missing keys
+        return replies.TYPE_REPLIES[db.get_type(self.key_str)]
 
     @staticmethod
     def craft_request(*args: str) -> "TypeCommand":
@@ -384,12 +440,20 @@ class TypeCommand(Command):
 
 
 class XaddCommand(Command):
+    __slots__ = ("stream_key_str", "stream_entry_id_str", "kv_dict")
+
     def __init__(
-        self, raw_cmd: bytes, stream_key: bytes, data: list[data_types.RespBulkString]
+        self,
+        raw_cmd: bytes | memoryview,
+        stream_key: bytes,
+        data: list[data_types.RespBulkString],
     ):
         self._raw_cmd = raw_cmd
-        self.stream_key = stream_key
-        self.data = data
+        self.stream_key_str = decode_key(stream_key)
+        self.stream_entry_id_str = data[0].data.decode()
+        self.kv_dict: dict[str, str] = {}
+        for i in range(1, len(data), 2):
+            self.kv_dict[data[i].data.decode()] = data[i + 1].data.decode()
 
     def execute(
         self,
@@ -397,22 +461,19 @@ class XaddCommand(Command):
         replica_handler,
         conn,
     ) -> bytes:
-        raw_stream_entry_id = self.data[0]
-        stream_entry_id = raw_stream_entry_id.data
-        err = db.validate_stream_id(self.stream_key.decode(), stream_entry_id.decode())
+        err = db.validate_stream_id(self.stream_key_str, self.stream_entry_id_str)
         if err is not None:
             return data_types.RespSimpleError(err).encode()
 
-        kv_dict = {}
-        for i in range(1, len(self.data), 2):
-            stream_key = self.data[i]
-            stream_value = self.data[i + 1]
-            kv_dict[stream_key.data.decode()] = stream_value.data.decode()
-        logger.info(f"{stream_entry_id=}, {kv_dict=}")
+        logger.info(
+            "self.stream_entry_id_str=%r, self.kv_dict=%r",
+            self.stream_entry_id_str,
+            self.kv_dict,
+        )
         processed_stream_id = db.xadd(
-            self.stream_key.decode(), stream_entry_id.decode(), kv_dict
+            self.stream_key_str, self.stream_entry_id_str, self.kv_dict
         )
-        return data_types.RespSimpleString(processed_stream_id.encode()).encode()
+        return replies.simple(processed_stream_id.encode())
 
     @staticmethod
     def craft_request(*args: str) -> "XaddCommand":
@@ -423,19 +484,21 @@ class XaddCommand(Command):
         return XaddCommand(
             craft_command("XADD", *args).encode(),
             args[0].encode(),
-            list(map(lambda x: data_types.RespBulkString(x.encode()), args[1:])),
+            [data_types.RespBulkString(x.encode()) for x in args[1:]],
         )
 
 
 class XrangeCommand(Command):
-    def __init__(self, raw_cmd: bytes, key: bytes, start: str, end: str):
+    __slots__ = ("key", "start", "end")
+
+    def __init__(self, raw_cmd: bytes | memoryview, key: bytes, start: str, end: str):
         self._raw_cmd = raw_cmd
         self.key = key
         self.start = start
         self.end = end
 
     def execute(self, db: database.Database, replica_handler, conn) -> bytes:
-        return db.xrange(self.key.decode(), self.start, self.end)
+        return db.xrange(decode_key(self.key), self.start, self.end)
 
     @staticmethod
     def craft_request(*args: str) -> "XrangeCommand":
@@ -447,9 +510,11 @@ class XrangeCommand(Command):
 
 
 class XreadCommand(Command):
+    __slots__ = ("stream_keys", "ids", "timeout")
+
     def __init__(
         self,
-        raw_cmd: bytes,
+        raw_cmd: bytes | memoryview,
         stream_keys: list[str],
         ids: list[str],
         timeout: int | None = None,
@@ -460,6 +525,9 @@ class XreadCommand(Command):
         self.timeout = timeout
 
     def execute(self, db: database.Database, replica_handler, conn) -> bytes:
+        if self.timeout is not None:
+            # don't hold back writes queued earlier in the batch while blocked
+            replica_handler.flush_replicas()
         res = db.xread(self.stream_keys, self.ids, self.timeout)
         return res
 
@@ -485,7 +553,21 @@ class XreadCommand(Command):
         )
 
 
+def decode_key(data: bytes) -> str:
+    # short keys are cached so hot keys skip decoding, and the database lookup
+    # reuses a str with its hash already computed. the cache is cleared when
+    # full rather than evicting one at a time, which keeps it safe across
+    # connection threads without a lock
+    if len(data) > _KEY_CACHE_MAX_LEN:
+        return data.decode()
+    key = _key_cache.get(data)
+    if key is None:
+        if len(_key_cache) >= _KEY_CACHE_SIZE:
+            _key_cache.clear()
+        key = data.decode()
+        _key_cache[data] = key
+    return key
+
+
 def craft_command(*args: str) -> data_types.RespArray:
-    return data_types.RespArray(
-        list(map(lambda x: data_types.RespBulkString(x.encode()), args))
-    )
+    return data_types.RespArray([data_types.RespBulkString(x.encode()) for x in args])
@@ -1,5 +1,9 @@
 BUFFER_SIZE = 1024
 CONN_TIMEOUT = 15
+# kernel socket buffers for replication links, sized for the RDB transfer
+REPL_SOCKET_BUFFER_SIZE = 1 << 20
+# a replica's reads from its master, big enough to take a burst in one recv
+REPL_RECV_BUFFER_SIZE = 1 << 16
 MAX_STREAM_ID_SEQ_NO = 2**32 - 1
 
 OK_SIMPLE_RESP_STRING = "+OK\r\n"
@@ -1,32 +1,43 @@
-from abc import ABC, abstractmethod
+import bisect
+from typing import Callable
 
-import codec
 import constants
 import exceptions
 from logs import logger
 import rdb
 
 
-class RespDataType(ABC):
-    @abstractmethod
-    def __len__(self) -> int: ...
+# plain base class rather than an ABC, decoding goes through DECODERS instead
+# of resolving methods on the base
+class RespDataType:
+    # small int identifying the concrete type, cheaper to compare than
+    # isinstance on hot paths
+    _tag = -1
 
-    @abstractmethod
-    def encode(self) -> bytes: ...
+    def __len__(self) -> int:
+        raise NotImplementedError
+
+    def encode(self) -> bytes:
+        raise NotImplementedError
 
     @staticmethod
-    @abstractmethod
     # Returns the parsed object and the new pos
-    def decode(data: bytes, pos: int) -> tuple["RespDataType", int]: ...
+    def decode(
+        data: bytes, pos: int, seps: "SepIndex | None" = None
+    ) -> tuple["RespDataType", int]:
+        raise NotImplementedError
 
     @staticmethod
-    @abstractmethod
-    def validate(that) -> "RespDataType": ...
+    def validate(that) -> "RespDataType":
+        raise NotImplementedError
 
 
 class RespSimpleString(RespDataType):
+    _tag = 0
+
     def __init__(self, data: bytes):
         self.data = data
+        self._encoded: bytes | None = None
 
     def __len__(self) -> int:
         return len(self.data)
@@ -38,13 +49,16 @@ class RespSimpleString(RespDataType):
         return f"RespSimpleString({repr(self.data)})"
 
     def encode(self) -> bytes:
-        return b"+" + self.data + b"\r\n"
+        if self._encoded is None:
+            self._encoded = b"".join((b"+", self.data, b"\r\n"))
+        return self._encoded
 
     @staticmethod
-    def decode(data: bytes, pos: int) -> tuple["RespSimpleString", int]:
+    def decode(
+        data: bytes, pos: int, seps: "SepIndex | None" = None
+    ) -> tuple["RespSimpleString", int]:
         start = pos
-        while pos < len(data) and not is_sep(data, pos):
-            pos += 1
+        pos = find_sep(data, pos, seps)
         if pos >= len(data):
             logger.info("Invalid RESP simple string, missing \\r\\n separator")
         simple_str = data[start:pos]
@@ -54,31 +68,45 @@ class RespSimpleString(RespDataType):
 
     @staticmethod
     def validate(that) -> "RespSimpleString":
-        if not isinstance(that, RespSimpleString):
+        if type(that) is not RespSimpleString:
             raise exceptions.ValidationError(
                 f"Expected RespSimpleString, got {type(that)}"
             )
         return that
 
 
+# decimal bytes for small ints, lengths in replies are almost always short
+_INT_STR = [str(i).encode() for i in range(4096)]
+
+
+def itob(n: int) -> bytes:
+    return _INT_STR[n] if 0 <= n < 4096 else str(n).encode()
+
+
+# headers for the common array lengths
+_ARRAY_HEADERS = [b"*%d\r\n" % n for n in range(65)]
+
+
 class RespArray(RespDataType):
+    _tag = 1
+
     def __init__(self, elements: list[RespDataType]):
         self.elements = elements
+        self._encoded: bytes | None = None
 
     def __len__(self) -> int:
         return len(self.elements)
 
     def __getitem__(self, idx) -> list[RespDataType] | RespDataType:
-        res = self.elements.__getitem__(idx)
-        if isinstance(res, list):
-            return list(res)  # enables type hinting
-        else:
-            return res
+        # slicing a list already returns a new list
+        return self.elements[idx]
 
     def __setitem__(self, idx, value: RespDataType):
+        self._encoded = None
         self.elements.__setitem__(idx, value)
 
     def __delitem__(self, idx):
+        self._encoded = None
         self.elements.__delitem__(idx)
 
     def __str__(self) -> str:
@@ -88,15 +116,24 @@ class RespArray(RespDataType):
         return f"RespArray({repr(self.elements)})"
 
     def encode(self) -> bytes:
-        return f"*{len(self.elements)}\r\n".encode() + b"".join(
-            map(lambda x: x.encode(), self.elements)
-        )
+        if self._encoded is None:
+            n = len(self.elements)
+            header = (
+                _ARRAY_HEADERS[n]
+                if n < len(_ARRAY_HEADERS)
+                else b"*" + itob(n) + b"\r\n"
+            )
+            parts = [header]
+            parts.extend([element.encode() for element in self.elements])
+            self._encoded = b"".join(parts)
+        return self._encoded
 
     @staticmethod
-    def decode(data: bytes, pos: int) -> tuple["RespArray", int]:
+    def decode(
+        data: bytes, pos: int, seps: "SepIndex | None" = None
+    ) -> tuple["RespArray", int]:
         start = pos + 1
-        while pos < len(data) and not is_sep(data, pos):
-            pos += 1
+        pos = find_sep(data, pos, seps)
         if pos >= len(data):
             logger.info("Invalid RESP array, missing \\r\\n separator")
         array_len = int(data[start:pos])
@@ -104,21 +141,30 @@ class RespArray(RespDataType):
 
         elements: list[RespDataType] = []
         for _ in range(array_len):
-            element, pos = codec.dispatch(data, pos)
+            decoder = DECODERS.get(data[pos]) if pos < len(data) else None
+            if decoder is None:
+                logger.info(
+                    f"Raising exception: Unsupported data type {data[pos:pos + 1]!r}"
+                )
+                raise Exception(f"Unsupported data type {data[pos:pos + 1]!r}")
+            element, pos = decoder(data, pos, seps)
             elements.append(element)
         assert pos <= len(data)
         return (RespArray(elements), pos)
 
     @staticmethod
     def validate(that) -> "RespArray":
-        if not isinstance(that, RespArray):
+        if type(that) is not RespArray:
             raise exceptions.ValidationError(f"Expected RespArray, got {type(that)}")
         return that
 
 
 class RespBulkString(RespDataType):
+    _tag = 2
+
     def __init__(self, data: bytes):
         self.data = data
+        self._encoded: bytes | None = None
 
     def __len__(self) -> int:
         return len(self.data)
@@ -130,17 +176,20 @@ class RespBulkString(RespDataType):
         return f"RespBulkString({repr(self.data)})"
 
     def encode(self) -> bytes:
-        return (
-            f"${len(self.data)}\r\n".encode() + self.data + b"\r\n"
-            if self.data
-            else constants.NULL_BULK_RESP_STRING.encode()
-        )
+        if self._encoded is None:
+            self._encoded = (
+                b"".join((b"$", itob(len(self.data)), b"\r\n", self.data, b"\r\n"))
+                if self.data
+                else constants.NULL_BULK_RESP_STRING.encode()
+            )
+        return self._encoded
 
     @staticmethod
-    def decode(data: bytes, pos: int) -> tuple["RespBulkString", int]:
+    def decode(
+        data: bytes, pos: int, seps: "SepIndex | None" = None
+    ) -> tuple["RespBulkString", int]:
         start = pos + 1
-        while pos < len(data) and not is_sep(data, pos):
-            pos += 1
+        pos = find_sep(data, pos, seps)
         if pos >= len(data):
             logger.info("Invalid RESP bulk string, missing \\r\\n separator")
         bulk_str_len = int(data[start:pos])
@@ -153,22 +202,19 @@ class RespBulkString(RespDataType):
 
     @staticmethod
     def validate(that) -> "RespBulkString":
-        if not isinstance(that, RespBulkString):
+        if type(that) is not RespBulkString:
             raise exceptions.ValidationError(
                 f"Expected RespBulkString, got {type(that)}"
             )
         return that
 
-    @staticmethod
-    def safe_validate(that) -> tuple["RespBulkString", None] | tuple[None, str]:
-        if not isinstance(that, RespBulkString):
-            return that, f"Expected RespBulkString, got {type(that)}"
-        return that, None
-
 
 class RespInteger(RespDataType):
+    _tag = 3
+
     def __init__(self, val: int):
         self.val = val
+        self._encoded: bytes | None = None
 
     def __len__(self) -> int:
         return len(str(self.val))
@@ -180,13 +226,16 @@ class RespInteger(RespDataType):
         return f"RespInteger({repr(self.val)})"
 
     def encode(self) -> bytes:
-        return f":{self.val}\r\n".encode()
+        if self._encoded is None:
+            self._encoded = b"".join((b":", itob(self.val), b"\r\n"))
+        return self._encoded
 
     @staticmethod
-    def decode(data: bytes, pos: int) -> tuple["RespInteger", int]:
+    def decode(
+        data: bytes, pos: int, seps: "SepIndex | None" = None
+    ) -> tuple["RespInteger", int]:
         start = pos + 1
-        while pos < len(data) and not is_sep(data, pos):
-            pos += 1
+        pos = find_sep(data, pos, seps)
         if pos >= len(data):
             logger.info("Invalid RESP integer, missing \\r\\n separator")
         val = int(data[start:pos])
@@ -196,12 +245,14 @@ class RespInteger(RespDataType):
 
     @staticmethod
     def validate(that) -> "RespInteger":
-        if not isinstance(that, RespInteger):
+        if type(that) is not RespInteger:
             raise exceptions.ValidationError(f"Expected RespInteger, got {type(that)}")
         return that
 
 
 class RespSimpleError(RespDataType):
+    _tag = 4
+
     def __init__(self, data: bytes):
         self.data = data
 
@@ -218,10 +269,11 @@ class RespSimpleError(RespDataType):
         return b"-" + self.data + b"\r\n"
 
     @staticmethod
-    def decode(data: bytes, pos: int) -> tuple["RespSimpleError", int]:
+    def decode(
+        data: bytes, pos: int, seps: "SepIndex | None" = None
+    ) -> tuple["RespSimpleError", int]:
         start = pos + 1
-        while pos < len(data) and not is_sep(data, pos):
-            pos += 1
+        pos = find_sep(data, pos, seps)
         if pos >= len(data):
             logger.info("Invalid RESP simple error, missing \\r\\n separator")
         simple_err = data[start:pos]
@@ -231,7 +283,7 @@ class RespSimpleError(RespDataType):
 
     @staticmethod
     def validate(that) -> "RespSimpleError":
-        if not isinstance(that, RespSimpleError):
+        if type(that) is not RespSimpleError:
             raise exceptions.ValidationError(
                 f"Expected RespSimpleError, got {type(that)}"
             )
@@ -239,7 +291,9 @@ class RespSimpleError(RespDataType):
 
 
 class RespRdbFile(RespDataType):
-    def __init__(self, data: bytes):
+    _tag = 5
+
+    def __init__(self, data: rdb.RdbData):
         self.data = rdb.RdbFile(data)
 
     def __len__(self) -> int:
@@ -252,13 +306,14 @@ class RespRdbFile(RespDataType):
         return f"RdbFile({repr(self.data)})"
 
     def encode(self) -> bytes:
-        return f"${len(self.data)}\r\n".encode() + self.data.data
+        return b"".join((b"$", itob(len(self.data)), b"\r\n", self.data.data))
 
     @staticmethod
-    def decode(data: bytes, pos: int) -> tuple["RespRdbFile", int]:
+    def decode(
+        data: bytes, pos: int, seps: "SepIndex | None" = None
+    ) -> tuple["RespRdbFile", int]:
         start = pos + 1
-        while pos < len(data) and not is_sep(data, pos):
-            pos += 1
+        pos = find_sep(data, pos, seps)
         if pos >= len(data):
             logger.info("Invalid RDB file, missing \\r\\n separator")
         bulk_str_len = int(data[start:pos])
@@ -271,31 +326,76 @@ class RespRdbFile(RespDataType):
 
     @staticmethod
     def validate(that) -> "RespRdbFile":
-        if not isinstance(that, RespRdbFile):
+        if type(that) is not RespRdbFile:
             raise exceptions.ValidationError(f"Expected RdbFile, got {type(that)}")
         return that
 
 
-def decode_bulk_string_or_rdb(data: bytes, pos: int) -> tuple[RespDataType, int]:
+def decode_bulk_string_or_rdb(
+    data: bytes, pos: int, seps: "SepIndex | None" = None
+) -> tuple[RespDataType, int]:
     # check if the length ends with a sep
     orig = pos
     start = pos + 1
-    while pos < len(data) and not is_sep(data, pos):
-        pos += 1
+    pos = find_sep(data, pos, seps)
     if pos >= len(data):
         logger.info("Invalid bulk string/RDB file, missing \\r\\n separator")
     bulk_str_len = int(data[start:pos])
     pos += 2 + bulk_str_len
-    if is_sep(data, pos):
-        return RespBulkString.decode(data, orig)
+    # bulk strings end with a separator, RDB files don't
+    if data[pos : pos + 2] == b"\r\n":
+        return RespBulkString.decode(data, orig, seps)
     else:
-        return RespRdbFile.decode(data, orig)
+        return RespRdbFile.decode(data, orig, seps)
+
 
+# decoders keyed by the RESP type byte as an int
+DECODERS: dict[
+    int, Callable[[bytes, int, "SepIndex | None"], tuple[RespDataType, int]]
+] = {
+    ord("*"): RespArray.decode,
+    ord("$"): decode_bulk_string_or_rdb,
+    ord("+"): RespSimpleString.decode,
+    ord(":"): RespInteger.decode,
+    ord("-"): RespSimpleError.decode,
+}
 
-def is_sep(data: bytes, pos: int) -> bool:
-    # using slices to index data to get bytes instead of ints
-    return (
-        pos + 1 < len(data)
-        and data[pos : pos + 1] == b"\r"
-        and data[pos + 1 : pos + 2] == b"\n"
-    )
+
+class SepIndex:
+    # positions of every \r\n in a buffer, found up front with bytes.find which
+    # runs in C. \r\n can't overlap itself so skipping past each match misses
+    # nothing. decoders consume separators mostly in order, so a cursor makes
+    # the common lookup O(1) and only bulk payloads containing \r\n need a
+    # binary search to resync
+    __slots__ = ("seps", "cursor", "end")
+
+    def __init__(self, data: bytes):
+        self.seps: list[int] = []
+        self.cursor = 0
+        self.end = len(data)
+        i = data.find(b"\r\n")
+        while i != -1:
+            self.seps.append(i)
+            i = data.find(b"\r\n", i + 2)
+
+    def next(self, pos: int) -> int:
+        # returns the position of the next \r\n at or after pos, or the end
+        seps = self.seps
+        i = self.cursor
+        if i < len(seps) and seps[i] < pos:
+            i += 1
+            if i < len(seps) and seps[i] < pos:
+                i = bisect.bisect_left(seps, pos, i)
+        elif i > 0 and seps[i - 1] >= pos:
+            # moved backwards
+            i = bisect.bisect_left(seps, pos, 0, i)
+        self.cursor = i
+        return seps[i] if i < len(seps) else self.end
+
+
+def find_sep(data: bytes, pos: int, seps: SepIndex | None = None) -> int:
+    # returns the position of the next \r\n at or after pos, or len(data)
+    if seps is None:
+        sep = data.find(b"\r\n", pos)
+        return len(data) if sep == -1 else sep
+    return seps.next(pos)
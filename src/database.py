@@ -1,110 +1,202 @@
 import bisect
-from datetime import datetime
-import functools
-from threading import RLock
+import mmap
+from threading import Condition, RLock
 import time
 import os
 
 import constants
-import data_types
 from logs import logger
 import rdb
+import replies
 import singleton_meta
 
 
+class Stream:
+    # entries are stored as parallel lists rather than a list of (id, fields)
+    # tuples. packed holds each id as a single int so range lookups can bisect
+    # it directly. the packed ids are far wider than an int64 so they stay a
+    # plain list
+    __slots__ = ("ms", "seq", "packed", "data")
+
+    def __init__(self):
+        self.ms: list[int] = []
+        self.seq: list[int] = []
+        self.packed: list[int] = []
+        self.data: list[dict[str, str]] = []
+
+    def __len__(self) -> int:
+        return len(self.packed)
+
+    def __repr__(self) -> str:
+        return f"Stream({list(zip(self.id_strs(), self.data))!r})"
+
+    @staticmethod
+    def pack(ms: int, seq: int) -> int:
+        # explicit ids can use any 64 bit seq, so it gets the low 64 bits to
+        # keep the ordering the same as comparing (ms, seq)
+        return (ms << 64) | seq
+
+    def append(self, ms: int, seq: int, fields: dict[str, str]):
+        # packed goes last since it defines the length, readers outside the
+        # lock never see an id without its fields
+        self.ms.append(ms)
+        self.seq.append(seq)
+        self.data.append(fields)
+        self.packed.append(self.pack(ms, seq))
+
+    def id_str(self, i: int) -> str:
+        return f"{self.ms[i]}-{self.seq[i]}"
+
+    def id_strs(self, lo: int = 0, hi: int | None = None) -> list[str]:
+        return [f"{ms}-{seq}" for ms, seq in zip(self.ms[lo:hi], self.seq[lo:hi])]
+
+
 class Database(metaclass=singleton_meta.SingletonMeta):
-    lock = RLock()
-    store_str_val_type = tuple[str, datetime | None]
-    store_stream_val_type = list[tuple["StreamId", dict[str, str]]]
-    store: dict[str, store_str_val_type | store_stream_val_type] = {}
+    # the store is split into shards by key hash, each with its own lock, so
+    # commands on different keys don't contend. the locks are reentrant since
+    # __getitem__ calls expire_one while holding its shard's lock
+    shard_count = 16
+    locks = [RLock() for _ in range(shard_count)]
+    # expiry is a unix timestamp in milliseconds
+    store_str_val_type = tuple[str, int | None]
+    shards: list[dict[str, store_str_val_type | Stream]] = [
+        {} for _ in range(shard_count)
+    ]
+    # notified on every xadd so blocked xreads wake up straight away. one
+    # condition for all streams since an xread can wait on streams in
+    # different shards
+    stream_added = Condition()
 
     def __init__(self, dir: str, dbfilename: str):
         self.dir = dir
         self.dbfilename = dbfilename
-        file_path = os.path.join(self.dir, self.dbfilename)
-        if os.path.exists(file_path):
-            with open(file_path, "rb") as f:
-                self.rdb = rdb.RdbFile(f.read())
+        self.file_path = os.path.join(self.dir, self.dbfilename)
+        if os.path.exists(self.file_path) and os.path.getsize(self.file_path) > 0:
+            # map the dump instead of reading it in, pages are loaded on demand
+            # as the parser walks the file and are shared with the page cache
+            with open(self.file_path, "rb") as f:
+                self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self.rdb = rdb.RdbFile(self._mmap)
         else:
             self.rdb = rdb.RdbFile(constants.EMPTY_RDB_FILE)
-        for key, value in self.rdb.key_values.items():
-            self.store[key] = value
-        logger.info(f"db initialised with {self.store=}")
+        self.load(self.rdb.key_values)
+        logger.info(f"db initialised with {self}")
+
+    def load(self, key_values: dict[str, store_str_val_type]):
+        # bucket by shard first so each shard is filled with one update under
+        # one lock acquire, instead of locking per key
+        buckets: list[dict[str, Database.store_str_val_type]] = [
+            {} for _ in range(self.shard_count)
+        ]
+        mask = self.shard_count - 1
+        for key, value in key_values.items():
+            buckets[hash(key) & mask][key] = value
+        for lock, shard, bucket in zip(self.locks, self.shards, buckets):
+            if bucket:
+                with lock:
+                    shard.update(bucket)
+
+    def _shard(self, key: str) -> int:
+        return hash(key) & (self.shard_count - 1)
 
     def __len__(self) -> int:
-        with self.lock:
-            return len(self.store)
-
-    def __getitem__(self, key: str) -> str | store_stream_val_type | None:
-        with self.lock:
-            if key not in self.store:
+        total = 0
+        for lock, shard in zip(self.locks, self.shards):
+            with lock:
+                total += len(shard)
+        return total
+
+    def __getitem__(self, key: str) -> str | Stream | None:
+        i = self._shard(key)
+        with self.locks[i]:
+            value = self.shards[i].get(key)
+            if value is None:
                 return None
-            value = self.store[key]
-            if isinstance(value, list):
+            if isinstance(value, Stream):
                 return value
             if value[1] and self.expire_one(key):
                 return None
             return value[0]
 
     def __setitem__(self, key: str, value: store_str_val_type):
-        with self.lock:
-            self.store[key] = value
+        i = self._shard(key)
+        with self.locks[i]:
+            self.shards[i][key] = value
 
     def __delitem__(self, key: str):
-        with self.lock:
-            del self.store[key]
+        i = self._shard(key)
+        with self.locks[i]:
+            del self.shards[i][key]
 
     def __contains__(self, key: str) -> bool:
-        with self.lock:
-            return key in map(lambda x: x, self.store.keys())
+        i = self._shard(key)
+        with self.locks[i]:
+            return key in self.shards[i]
+
+    def items(self) -> list[tuple[str, store_str_val_type | Stream]]:
+        # snapshot of every key, taken one shard at a time
+        res: list[tuple[str, Database.store_str_val_type | Stream]] = []
+        for lock, shard in zip(self.locks, self.shards):
+            with lock:
+                res.extend(shard.items())
+        return res
 
     def __str__(self) -> str:
-        with self.lock:
-            return str(self.store)
+        return str(dict(self.items()))
 
     def __repr__(self) -> str:
-        with self.lock:
-            return f"Store({repr(self.store)})"
+        return f"Store({repr(dict(self.items()))})"
 
     def get_type(self, key: str) -> str:
-        with self.lock:
-            if key not in self.store:
+        i = self._shard(key)
+        with self.locks[i]:
+            value = self.shards[i].get(key)
+            if value is None:
                 return "none"
-            value = self.store[key]
-            if isinstance(value, list):
+            if isinstance(value, Stream):
                 return "stream"
             return "string"
 
     def expire(self):
-        with self.lock:
-            for key, value in self.store.items():
-                if not isinstance(value, list):
-                    _, expiry = value
-                    if expiry and expiry < datetime.now():
-                        del self.store[key]
+        now = time.time_ns() // 1_000_000
+        for lock, shard in zip(self.locks, self.shards):
+            with lock:
+                # collect first, deleting while iterating a dict raises
+                expired = [
+                    key
+                    for key, value in shard.items()
+                    if not isinstance(value, Stream) and value[1] and value[1] < now
+                ]
+                for key in expired:
+                    del shard[key]
 
     def expire_one(self, key: str) -> bool:
         # returns True if key was expired
-        with self.lock:
-            value = self.store[key]
-            if isinstance(value, list):
+        i = self._shard(key)
+        with self.locks[i]:
+            shard = self.shards[i]
+            value = shard[key]
+            if isinstance(value, Stream):
                 return False
             expiry = value[1]
-            if expiry and expiry < datetime.now():
-                del self.store[key]
+            if expiry and expiry < time.time_ns() // 1_000_000:
+                del shard[key]
                 return True
             return False
 
     def validate_stream_id(self, key: str, id: str) -> bytes | None:
-        with self.lock:
-            if key not in self.store:
+        i = self._shard(key)
+        with self.locks[i]:
+            cur_value = self.shards[i].get(key)
+            if cur_value is None:
                 return None
-            cur_value = self.store[key]
-            if not isinstance(cur_value, list):
+            if not isinstance(cur_value, Stream):
                 return constants.STREAM_ID_NOT_GREATER_ERROR.encode()
             if id == "*":
                 return None
-            milliseconds_time, seq_no = id.split("-")
+            milliseconds_time, sep, seq_no = id.partition("-")
+            if not sep:
+                raise Exception(f"Invalid stream id {id}")
             seq_no_is_star = seq_no == "*"
 
             is_0_0 = milliseconds_time == "0" and seq_no == "0"
@@ -112,35 +204,40 @@ class Database(metaclass=singleton_meta.SingletonMeta):
                 return constants.STREAM_ID_TOO_SMALL_ERROR.encode()
             if not cur_value:
                 return None
-            last_mst, last_seq_no = str(cur_value[-1][0]).split("-")
-            if int(milliseconds_time) < int(last_mst):
+            last_mst, last_seq_no = cur_value.ms[-1], cur_value.seq[-1]
+            if int(milliseconds_time) < last_mst:
                 return constants.STREAM_ID_NOT_GREATER_ERROR.encode()
             elif seq_no_is_star:
                 return None
-            elif int(milliseconds_time) == int(last_mst) and int(seq_no) <= int(
-                last_seq_no
-            ):
+            elif int(milliseconds_time) == last_mst and int(seq_no) <= last_seq_no:
                 return constants.STREAM_ID_NOT_GREATER_ERROR.encode()
             return None
 
     def xadd(self, key: str, id: str, value: dict) -> str:
         # stream key has already been validated
-        with self.lock:
-            if key not in self.store:
-                self.store[key] = []
-            cur_value = self.store[key]
-            if not isinstance(cur_value, list):
+        i = self._shard(key)
+        with self.locks[i]:
+            cur_value = self.shards[i].setdefault(key, Stream())
+            if not isinstance(cur_value, Stream):
                 raise Exception(f"key {key} is not a stream")
-            processed_id = StreamId.generate_stream_id(
-                id, str(cur_value[-1][0]) if cur_value else None
-            )
-            cur_value.append((processed_id, value))
-            return str(processed_id)
+            if cur_value:
+                processed_id = StreamId.generate_stream_id(
+                    id, cur_value.ms[-1], cur_value.seq[-1]
+                )
+            else:
+                processed_id = StreamId.generate_stream_id(id, None, None)
+            cur_value.append(processed_id.ms, processed_id.seq, value)
+        # notify after releasing the shard lock, xread takes the shard locks
+        # while holding stream_added
+        with self.stream_added:
+            self.stream_added.notify_all()
+        return str(processed_id)
 
     def xrange(self, key: str, start: str, end: str) -> bytes:
-        with self.lock:
-            value = self.store[key]
-            if not isinstance(value, list):
+        i = self._shard(key)
+        with self.locks[i]:
+            value = self.shards[i][key]
+            if not isinstance(value, Stream):
                 return constants.XOP_ON_NON_STREAM_ERROR.encode()
             if start == "-":
                 start = "0-1"
@@ -148,7 +245,7 @@ class Database(metaclass=singleton_meta.SingletonMeta):
                 start = f"{start}-0"
             if end == "+":
                 end = (
-                    str(value[-1][0])
+                    value.id_str(-1)
                     if value
                     else f"{constants.MAX_STREAM_ID_SEQ_NO}-{constants.MAX_STREAM_ID_SEQ_NO}"
                 )
@@ -157,159 +254,162 @@ class Database(metaclass=singleton_meta.SingletonMeta):
             start_stream_id = StreamId(start)
             end_stream_id = StreamId(end)
 
-            lo = bisect.bisect_right(value, start_stream_id, key=lambda x: x[0])
+            # both ends are inclusive
+            lo = bisect.bisect_left(
+                value.packed,
+                Stream.pack(start_stream_id.ms, start_stream_id.seq),
+            )
             if lo >= len(value):
-                return data_types.RespArray([]).encode()
-            hi = bisect.bisect_right(value, end_stream_id, key=lambda x: x[0])
-            if hi >= len(value):
-                hi = len(value)
-
-            res = []
-            for i in range(lo - 1 if lo != 0 else 0, hi):
-                flattened_kvs = []
-                for k, v in value[i][1].items():
-                    flattened_kvs.append(data_types.RespBulkString(k.encode()))
-                    flattened_kvs.append(data_types.RespBulkString(v.encode()))
-                res.append(
-                    data_types.RespArray(
-                        [
-                            data_types.RespBulkString(str(value[i][0]).encode()),
-                            data_types.RespArray(flattened_kvs),
-                        ]
-                    )
-                )
-            return data_types.RespArray(res).encode()
+                return replies.EMPTY_ARRAY
+            hi = bisect.bisect_right(
+                value.packed,
+                Stream.pack(end_stream_id.ms, end_stream_id.seq),
+            )
+            # an end before the start is an empty range, not a null array
+            if hi <= lo:
+                return replies.EMPTY_ARRAY
+
+            out = bytearray()
+            self.write_stream_entries(out, value, lo, hi)
+            return bytes(out)
+
+    def write_stream_entries(
+        self, out: bytearray, value: Stream, lo: int = 0, hi: int | None = None
+    ):
+        # writes the entries straight into out as a RESP array, without building
+        # RespArrays for each entry first
+        if hi is None:
+            hi = len(value)
+        ms, seq, data = value.ms, value.seq, value.data
+        out += b"*%d\r\n" % (hi - lo)
+        for i in range(lo, hi):
+            _write_xentry(out, b"%d-%d" % (ms[i], seq[i]), data[i])
+
+    def stream_len(self, key: str) -> int:
+        i = self._shard(key)
+        with self.locks[i]:
+            return len(self.shards[i][key])
 
     def xread(
         self, stream_keys: list[str], ids: list[str], timeout: int | None
     ) -> bytes:
         if timeout is not None:
-            with self.lock:
-                original_lens = [
-                    len(self.store[stream_key]) for stream_key in stream_keys
-                ]
-            logger.info(f"{original_lens=}")
-            if timeout != 0:
-                time.sleep(timeout / 1e3)
-            else:
-                while True:
-                    time.sleep(0.5)
-                    with self.lock:
-                        new_lens = [
-                            len(self.store[stream_key]) for stream_key in stream_keys
-                        ]
-                        to_break = False
-                        for i in range(len(original_lens)):
-                            if new_lens[i] != original_lens[i]:
-                                to_break = True
-                        if to_break:
-                            logger.info(f"{new_lens=}")
-                            break
-
-        with self.lock:
-            res = []
-            for i in range(len(stream_keys)):
-                stream_key = stream_keys[i]
-                id = ids[i]
-                value = self.store[stream_key]
-                if not isinstance(value, list):
+            original_lens = [self.stream_len(stream_key) for stream_key in stream_keys]
+            logger.info("original_lens=%r", original_lens)
+            with self.stream_added:
+                # a timeout of 0 blocks until an entry arrives
+                self.stream_added.wait_for(
+                    lambda: [self.stream_len(stream_key) for stream_key in stream_keys]
+                    != original_lens,
+                    timeout / 1e3 if timeout != 0 else None,
+                )
+
+        out = bytearray(b"*%d\r\n" % len(stream_keys))
+        for i in range(len(stream_keys)):
+            stream_key = stream_keys[i]
+            id = ids[i]
+            shard_idx = self._shard(stream_key)
+            with self.locks[shard_idx]:
+                value = self.shards[shard_idx][stream_key]
+                if not isinstance(value, Stream):
                     return constants.XOP_ON_NON_STREAM_ERROR.encode()
                 if id == "$":
-                    logger.info(f"{original_lens[i]}")
-                    id = str(value[original_lens[i] - 1][0]) if value else "0-0"
+                    logger.info("%d", original_lens[i])
+                    id = value.id_str(original_lens[i] - 1) if value else "0-0"
                 stream_id = StreamId(id)
 
-                lo = bisect.bisect_right(value, stream_id, key=lambda x: x[0])
-                if lo >= len(value):
-                    return constants.NULL_BULK_RESP_STRING.encode()
-
-                inter: list[data_types.RespDataType] = []
-                for i in range(lo, len(value)):
-                    flattened_kvs = []
-                    for k, v in value[i][1].items():
-                        flattened_kvs.append(data_types.RespBulkString(k.encode()))
-                        flattened_kvs.append(data_types.RespBulkString(v.encode()))
-                    inter.append(
-                        data_types.RespArray(
-                            [
-                                data_types.RespBulkString(str(value[i][0]).encode()),
-                                data_types.RespArray(flattened_kvs),
-                            ]
-                        )
-                    )
-                res.append(
-                    data_types.RespArray(
-                        [
-                            data_types.RespBulkString(stream_key.encode()),
-                            data_types.RespArray(inter),
-                        ]
-                    )
+                lo = bisect.bisect_right(
+                    value.packed,
+                    Stream.pack(stream_id.ms, stream_id.seq),
                 )
-            return data_types.RespArray(res).encode()
+                if lo >= len(value):
+                    return replies.NULL_BULK
+
+                key_bytes = stream_key.encode()
+                out += b"*2\r\n$%d\r\n%s\r\n" % (len(key_bytes), key_bytes)
+                self.write_stream_entries(out, value, lo)
+        return bytes(out)
+
+
+def _write_xentry(out: bytearray, stream_id: bytes, kvs: dict[str, str]):
+    # [id, [k1, v1, k2, v2, ...]]
+    out += b"*2\r\n$%d\r\n%s\r\n*%d\r\n" % (len(stream_id), stream_id, 2 * len(kvs))
+    for k, v in kvs.items():
+        k_bytes = k.encode()
+        v_bytes = v.encode()
+        out += b"$%d\r\n%s\r\n$%d\r\n%s\r\n" % (
+            len(k_bytes),
+            k_bytes,
+            len(v_bytes),
+            v_bytes,
+        )
 
 
-@functools.total_ordering
 class StreamId:
+    __slots__ = ("ms", "seq")
+
     def __init__(self, id_str: str):
-        milliseconds_time, seq_no = id_str.split("-")
-        self.validate(milliseconds_time, seq_no)
-        self.milliseconds_time = milliseconds_time
-        self.seq_no = seq_no
-
-    def validate(self, milliseconds_time: str, seq_no: str) -> bool:
-        if milliseconds_time == "0" and seq_no == "0":
-            logger.info(f"Invalid stream id {milliseconds_time}-{seq_no}")
+        ms_str, sep, seq_str = id_str.partition("-")
+        if not sep:
+            raise Exception(f"Invalid stream id {id_str}")
+        self.ms = int(ms_str)
+        self.seq = int(seq_str)
+        self.validate()
+
+    @staticmethod
+    def from_ints(ms: int, seq: int) -> "StreamId":
+        stream_id = StreamId.__new__(StreamId)
+        stream_id.ms = ms
+        stream_id.seq = seq
+        return stream_id
+
+    def validate(self) -> bool:
+        if self.ms == 0 and self.seq == 0:
+            logger.info("Invalid stream id %d-%d", self.ms, self.seq)
             return False
         return True
 
     @staticmethod
-    def generate_stream_id(id: str, last_id: str | None) -> "StreamId":
+    def generate_stream_id(
+        id: str, last_ms: int | None, last_seq: int | None
+    ) -> "StreamId":
+        # last_ms and last_seq are the stream's current top id, None if empty
         if id == "*":
             # milliseconds_time should be current time in milliseconds
-            milliseconds_time = str(int(datetime.now().timestamp() * 1000))
-            if not last_id:
-                return StreamId(f"{milliseconds_time}-0")
-            splitted_last = last_id.split("-")
-            if splitted_last[0] == milliseconds_time:
-                return StreamId(f"{milliseconds_time}-{int(splitted_last[1]) + 1}")
-            return StreamId(f"{milliseconds_time}-0")
-
-        splitted = id.split("-")
-        if len(splitted) != 2:
+            milliseconds_time = time.time_ns() // 1_000_000
+            if last_ms == milliseconds_time and last_seq is not None:
+                return StreamId.from_ints(milliseconds_time, last_seq + 1)
+            return StreamId.from_ints(milliseconds_time, 0)
+
+        ms_str, sep, seq_no = id.partition("-")
+        if not sep:
             raise Exception(f"Invalid stream id {id}")
-        milliseconds_time, seq_no = splitted
-        if not last_id:
-            if seq_no == "*":
-                seq_no = "1" if milliseconds_time == "0" else "0"
-            return StreamId(f"{milliseconds_time}-{seq_no}")
-
-        splitted_last = last_id.split("-")
-        last_milliseconds_time, last_seq_no = splitted_last
-        if seq_no == "*":
-            if milliseconds_time == last_milliseconds_time:
-                seq_no = str(int(last_seq_no) + 1)
-            else:
-                seq_no = "1" if milliseconds_time == "0" else "0"
-        return StreamId(f"{milliseconds_time}-{seq_no}")
+        milliseconds_time = int(ms_str)
+        if seq_no != "*":
+            return StreamId.from_ints(milliseconds_time, int(seq_no))
+        if milliseconds_time == last_ms and last_seq is not None:
+            return StreamId.from_ints(milliseconds_time, last_seq + 1)
+        return StreamId.from_ints(milliseconds_time, 1 if milliseconds_time == 0 else 0)
 
     def __repr__(self) -> str:
-        return f"StreamId({self.milliseconds_time}-{self.seq_no})"
+        return f"StreamId({self.ms}-{self.seq})"
 
     def __str__(self) -> str:
-        return f"{self.milliseconds_time}-{self.seq_no}"
+        return f"{self.ms}-{self.seq}"
 
     def __eq__(self, other) -> bool:
         if not isinstance(other, StreamId):
             return False
-        return (
-            self.milliseconds_time == other.milliseconds_time
-            and self.seq_no == other.seq_no
-        )
+        return self.ms == other.ms and self.seq == other.seq
+
+    def __lt__(self, other: "StreamId") -> bool:
+        return (self.ms, self.seq) < (other.ms, other.seq)
+
+    def __le__(self, other: "StreamId") -> bool:
+        return (self.ms, self.seq) <= (other.ms, other.seq)
 
-    def __lt__(self, other: "StreamId"):
-        if self.milliseconds_time != other.milliseconds_time:
-            return self.milliseconds_time < other.milliseconds_time
-        return self.seq_no < other.seq_no
+    def __hash__(self) -> int:
+        return hash((self.ms, self.seq))
 
     def next_seq_id(self) -> "StreamId":
-        return StreamId(f"{self.milliseconds_time}-{int(self.seq_no) + 1}")
+        return StreamId.from_ints(self.ms, self.seq + 1)
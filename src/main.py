@@ -1,6 +1,6 @@
 import argparse
 import os
-import select
+import selectors
 import socket
 import threading
 
@@ -23,7 +23,7 @@ def main():
     if either[1] is not None:
         logger.error(f"Error parsing command line arguments: {either[1]}")
         return
-    port, replicaof, rdbdir, dbfilename = either[0]
+    port, replicaof, rdbdir, dbfilename, unixsocket = either[0]
     db = database.Database(rdbdir, dbfilename)
     replica_handler = replicas.ReplicaHandler(
         False if replicaof else True, "localhost", port, replicaof, db
@@ -39,11 +39,23 @@ def main():
                 # fix for non linux: ignore the error
                 pass
         server_socket.bind(("localhost", port))
+        server_socket.listen()
+        # register once with the platform's best selector (epoll/kqueue) rather
+        # than rebuilding a select() set every loop. the timeout stays so
+        # Ctrl+C is still handled on Windows, where a blocked select ignores it
+        sel = selectors.DefaultSelector()
+        sel.register(server_socket, selectors.EVENT_READ)
+        if unixsocket is not None:
+            # local clients and replicas can skip the TCP stack entirely
+            if os.path.exists(unixsocket):
+                os.unlink(unixsocket)
+            unix_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            unix_socket.bind(unixsocket)
+            unix_socket.listen()
+            sel.register(unix_socket, selectors.EVENT_READ)
         while True:
-            server_socket.listen()
-            ready = select.select([server_socket], [], [], 0.5)
-            if ready[0]:
-                conn, addr = server_socket.accept()
+            for key, _ in sel.select(0.5):
+                conn, addr = key.fileobj.accept()
                 thread = threading.Thread(
                     target=handle_conn, args=(conn, addr, db, replica_handler)
                 )
@@ -59,15 +71,26 @@ def handle_conn(
     db: database.Database,
     replica_handler: replicas.ReplicaHandler,
 ):
+    # receive into one buffer for the life of the connection. each frame is
+    # copied out once at its exact size since parsed commands (and the parse
+    # cache) keep references to it past the next recv
+    buf = bytearray(constants.BUFFER_SIZE)
+    view = memoryview(buf)
     with conn:
         while True:
-            data = conn.recv(constants.BUFFER_SIZE)
-            if not data:
+            n = conn.recv_into(buf)
+            if not n:
                 break
-            logger.info(f"raw {data=}")
+            data = bytes(view[:n])
+            logger.info("raw data=%r", data)
             cmds = codec.parse_cmd(data)
+            propagated = replica_handler.propagated
             for cmd in cmds:
                 execute_cmd(cmd, db, replica_handler, conn)
+            # send whatever the batch queued for replicas in one go, read only
+            # batches have nothing to send
+            if replica_handler.propagated != propagated:
+                replica_handler.flush_replicas()
 
         logger.info(f"Connection closed: {addr=}")
 
@@ -80,22 +103,39 @@ def execute_cmd(
 ):
     executed = cmd.execute(db, replica_handler, conn)
     if isinstance(executed, list):
-        for resp in executed:
-            logger.info(f"responding {resp}")
-            conn.sendall(resp)
+        # one write for the whole batch instead of one per reply
+        logger.info("responding %s", executed)
+        conn.sendall(b"".join(executed))
     else:
-        logger.info(f"responding {executed}")
+        logger.info("responding %s", executed)
         conn.sendall(executed)
 
 
 def validate_parse_args(
     args: argparse.Namespace,
-) -> tuple[tuple[int, tuple[str, int] | None, str, str], None] | tuple[None, str]:
+) -> (
+    tuple[tuple[int, tuple[str, int | str] | None, str, str, str | None], None]
+    | tuple[None, str]
+):
     if not isinstance(args.port, int) or args.port < 0 or args.port > 65535:
         return None, "Invalid port number"
+    has_unix = hasattr(socket, "AF_UNIX")
+    if args.unixsocket is not None and not has_unix:
+        return None, "unix sockets are not supported on this platform"
     if args.replicaof is not None:
         if not isinstance(args.replicaof, list) or len(args.replicaof) != 2:
             return None, "replicaof is not a list of length 2"
+        if args.replicaof[0] == "unix":
+            # master on this machine, the second value is its socket path
+            if not has_unix:
+                return None, "unix sockets are not supported on this platform"
+            return (
+                args.port,
+                ("unix", args.replicaof[1]),
+                args.dir,
+                args.dbfilename,
+                args.unixsocket,
+            ), None
         try:
             replicaof_int = int(args.replicaof[1])
         except:
@@ -105,8 +145,9 @@ def validate_parse_args(
             (args.replicaof[0], replicaof_int),
             args.dir,
             args.dbfilename,
+            args.unixsocket,
         ), None
-    return (args.port, None, args.dir, args.dbfilename), None
+    return (args.port, None, args.dir, args.dbfilename, args.unixsocket), None
 
 
 def setup_argpaser() -> argparse.ArgumentParser:
@@ -121,7 +162,7 @@ def setup_argpaser() -> argparse.ArgumentParser:
         type=str,
         nargs=2,
         default=None,
-        help="Master IP and port to replicate from (default: None)",
+        help="Master IP and port to replicate from, or unix and the master's socket path (default: None)",
     )
     argparser.add_argument(
         "--dir",
@@ -135,6 +176,12 @@ def setup_argpaser() -> argparse.ArgumentParser:
         default="dump.rdb",
         help="The name of the RDB file (default: dump.rdb)",
     )
+    argparser.add_argument(
+        "--unixsocket",
+        type=str,
+        default=None,
+        help="Unix socket path to also listen on, not available on Windows (default: None)",
+    )
     return argparser
 
 
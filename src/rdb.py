@@ -1,19 +1,33 @@
-import datetime
+import mmap
+import struct
 
 import constants
 from logs import logger
 
+# fixed width fields. lengths are big endian, everything else is little endian
+_U32_BE = struct.Struct(">I")
+_U32_LE = struct.Struct("<I")
+_U64_LE = struct.Struct("<Q")
+# integer encoded strings, keyed by their width in bytes
+_INT_STRUCTS = {1: struct.Struct("<b"), 2: struct.Struct("<h"), 4: struct.Struct("<i")}
+# what an RDB can be parsed from. the parser only slices, indexes and unpacks,
+# so a replica's receive buffer, views and the mapped dump file are read in place
+RdbData = bytes | bytearray | memoryview | mmap.mmap
+
 
 class RdbFile:
-    def __init__(self, data: bytes):
-        self.data = data
+    def __init__(self, data: RdbData):
+        self.data: RdbData = data
         self.idx = 9  # ignore magic string and version number
         self.buffer = []
-        self.key_values: dict[str, tuple[str, datetime.datetime | None]] = {}
+        self.key_values: dict[str, tuple[str, int | None]] = {}
         err = self.read_rdb()
         if err is not None:
             logger.error(f"Failed to read RDB file with error {err}, defaulting to empty file")
             self.data = constants.EMPTY_RDB_FILE
+            self.idx = 9
+            self.buffer = []
+            self.key_values = {}
             self.read_rdb()
 
     def __len__(self) -> int:
@@ -22,37 +36,46 @@ class RdbFile:
     def read_rdb(self) -> str | None:
         sanity_check = self.data[0:5]
         if sanity_check != b"REDIS":
-            return f"Invalid RDB file, magic bytes are not REDIS: {sanity_check}"
+            return f"Invalid RDB file, magic bytes are not REDIS: {bytes(sanity_check)}"
         try:
             # check version number
             int.from_bytes(self.data[5:9], byteorder="little")
         except:
             return f"Invalid RDB file, got version number: {self.data[5:9]}"
-        while self.idx < len(self.data):
-            self.parse()
+        try:
+            while self.idx < len(self.data):
+                self.parse()
+        except (IndexError, struct.error):
+            return f"Invalid RDB file, truncated at {self.idx}"
 
     def read(self, length: int) -> bytes:
-        data = self.data[self.idx : self.idx + length]
+        # bytes and mmap slices are already bytes, other slices are copied
+        data = bytes(self.data[self.idx : self.idx + length])
         self.idx += length
         return data
 
+    def read_byte(self) -> int:
+        byte = self.data[self.idx]
+        self.idx += 1
+        return byte
+
+    def read_struct(self, fmt: struct.Struct) -> int:
+        val = fmt.unpack_from(self.data, self.idx)[0]
+        self.idx += fmt.size
+        return val
+
     def read_length_encoding(self) -> tuple[int, int, int]:
-        length_encoding = self.read(1)
-        return (
-            int.from_bytes(length_encoding) >> 7,
-            (int.from_bytes(length_encoding) >> 6) & 1,
-            int.from_bytes(length_encoding) & 0x3F,
-        )
+        length_encoding = self.read_byte()
+        return length_encoding >> 7, (length_encoding >> 6) & 1, length_encoding & 0x3F
 
     def read_length_encoded_integer(self) -> tuple[int, bool]:
         le0, le1, rest = self.read_length_encoding()
         if le0 == 0 and le1 == 0:
             return rest, False
         elif le0 == 0 and le1 == 1:
-            next_byte = self.read(1)
-            return (rest << 8) | int.from_bytes(next_byte), False
-        elif le0 == 1 and le0 == 0:
-            return int.from_bytes(self.read(4)), False
+            return (rest << 8) | self.read_byte(), False
+        elif le0 == 1 and le1 == 0:
+            return self.read_struct(_U32_BE), False
         else:
             if rest == 0:
                 return 1, True
@@ -66,48 +89,43 @@ class RdbFile:
 
     def read_length_encoded_string(self) -> bytes:
         length, is_int = self.read_length_encoded_integer()
-        val = self.read(length)
         if is_int:
-            return str(int.from_bytes(val)).encode()
+            return str(self.read_struct(_INT_STRUCTS[length])).encode()
         else:
-            return val
+            return self.read(length)
 
     def parse(self):
-        logger.info(f"{self.data[self.idx:]}")
-        op_code = self.read(1)
+        # log the position rather than the remaining data, slicing the tail on
+        # every opcode made loading quadratic in the file size
+        logger.info("RdbFile.parse idx=%d", self.idx)
+        op_code = self.read_byte()
         match op_code:
-            case b"\xff":
+            case 0xFF:
                 # EOF, remaining is 8 bit crc
                 self.idx = len(self.data)
                 return
-            case b"\xfe":
+            case 0xFE:
                 # database selector
                 db_selector = self.read_length_encoded_integer()[0]
                 self.buffer.append(("db", db_selector))
-            case b"\xfd":
-                # expiry time in s
-                expiry = datetime.datetime.fromtimestamp(
-                    int.from_bytes(self.read(4), "little"), datetime.UTC
-                )
-                expiry = expiry.replace(tzinfo=None)
-                key, value = self.parse_kv(self.read(1))
+            case 0xFD:
+                # expiry time in s, stored as ms
+                expiry = self.read_struct(_U32_LE) * 1000
+                key, value = self.parse_kv(self.read_byte())
                 self.key_values[key.decode()] = (value.decode(), expiry)
-            case b"\xfc":
+            case 0xFC:
                 # expiry time in ms
-                expiry = datetime.datetime.fromtimestamp(
-                    int.from_bytes(self.read(8), "little") / 1e3, datetime.UTC
-                )
-                expiry = expiry.replace(tzinfo=None)
-                key, value = self.parse_kv(self.read(1))
+                expiry = self.read_struct(_U64_LE)
+                key, value = self.parse_kv(self.read_byte())
                 self.key_values[key.decode()] = (value.decode(), expiry)
-            case b"\xfb":
+            case 0xFB:
                 # resizedb
                 db_hash_table_size = self.read_length_encoded_integer()[0]
                 expiry_hash_table_size = self.read_length_encoded_integer()[0]
                 self.buffer.append(
                     ("resizedb", db_hash_table_size, expiry_hash_table_size)
                 )
-            case b"\xfa":
+            case 0xFA:
                 # aux field
                 aux_key = self.read_length_encoded_string()
                 aux_value = self.read_length_encoded_string()
@@ -118,10 +136,10 @@ class RdbFile:
                 self.key_values[key.decode()] = (value.decode(), None)
                 return
 
-    def parse_kv(self, val_type: bytes) -> tuple[bytes, bytes]:
+    def parse_kv(self, val_type: int) -> tuple[bytes, bytes]:
         key = self.read_length_encoded_string()
         match val_type:
-            case b"\x00":
+            case 0x00:
                 # string
                 return key, self.read_length_encoded_string()
             case _:
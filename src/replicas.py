@@ -1,6 +1,19 @@
+# replication is bound by syscalls and copying, not computation. the bytes
+# going out to slaves already exist and the bytes from the master only need
+# framing, so speedups come from doing fewer sends, recvs and copies, not from
+# compiling or vectorising the parsing. the hot spots are:
+# - fan out to slaves: commands are appended once to a shared backlog and each
+#   slave gets one non-blocking send per flush (propogate, flush_replicas)
+# - full sync: the RDB goes out with socket.sendfile on its own thread
+# - reading from the master: one reused receive buffer, with StreamParser
+#   framing commands that a recv splits
+# - encoding replies: wire templates and single buffers instead of building
+#   Resp objects (handshake, INFO, ACK)
+import os
+import selectors
 import threading
-import uuid
 import socket
+from typing import Callable
 
 import codec
 import commands
@@ -8,8 +21,21 @@ import constants
 import database
 import data_types
 from logs import logger
+import replies
 import singleton_meta
 
+# makes a single send non-blocking without changing the socket, which the
+# slave's connection thread is blocked reading from. missing on windows
+_SEND_NOWAIT = getattr(socket, "MSG_DONTWAIT", None)
+_EMPTY_RDB_RESP = data_types.RespRdbFile(constants.EMPTY_RDB_FILE).encode()
+# handshake requests, the same on every connection apart from the port and id
+_HANDSHAKE_PING = b"*1\r\n$4\r\nPING\r\n"
+_HANDSHAKE_LISTENING_PORT = (
+    b"*3\r\n$8\r\nREPLCONF\r\n$14\r\nlistening-port\r\n$%d\r\n%b\r\n"
+)
+_HANDSHAKE_CAPA = b"*3\r\n$8\r\nREPLCONF\r\n$4\r\ncapa\r\n$6\r\npsync2\r\n"
+_HANDSHAKE_PSYNC = b"*3\r\n$5\r\nPSYNC\r\n$%d\r\n%b\r\n$2\r\n-1\r\n"
+
 
 class ReplicaHandler(metaclass=singleton_meta.SingletonMeta):
     def __init__(
@@ -17,84 +43,191 @@ class ReplicaHandler(metaclass=singleton_meta.SingletonMeta):
         is_master: bool,
         ip: str,
         port: int,
-        replica_of: tuple[str, int] | None,
+        replica_of: tuple[str, int | str] | None,
         db: database.Database,
     ):
         self.is_master = is_master
         self.ack_count = 0
-        self.id = str(uuid.uuid4())
+        # notified whenever a replica acks, used by WAIT
+        self.ack_cond = threading.Condition()
+        # 40 hex chars, the same shape as a real redis replication id
+        self.id = os.urandom(20).hex()
         self.ip = ip
         self.port = port
         if replica_of is not None:
             self.master_ip = replica_of[0]
             self.master_port = replica_of[1]
-        self.slaves: list[socket.socket] = []
+        # writes to propagate are appended once to a backlog shared by every
+        # slave and sent by flush_replicas, so a command is copied once however
+        # many slaves there are and a batch costs one send per slave.
+        # backlog_start is the offset of backlog[0] in everything propagated,
+        # the backlog is trimmed to the slowest slave
+        self.backlog = bytearray()
+        self.backlog_start = 0
+        # bumped on every propagate, lets a connection tell whether its batch
+        # queued anything that needs flushing
+        self.propagated = 0
+        # per slave state as parallel lists, so the flush loop walks plain
+        # lists instead of looking each slave up. slave_offsets is how far
+        # into the backlog a slave has been sent, slave_ready is whether its
+        # full sync is done. all of it changes under pending_lock, and slaves
+        # is a tuple replaced whole rather than changed in place, so threads
+        # reading it without the lock (WAIT, INFO) always see a consistent one
+        self.slaves: tuple[socket.socket, ...] = ()
+        self.slave_offsets: list[int] = []
+        self.slave_ready: list[bool] = []
+        self.pending_lock = threading.Lock()
+        # slaves whose kernel buffer filled up, drained by drain_thread. kept
+        # as a set too since looking a closed socket up in the selector raises
+        self.write_sel = selectors.DefaultSelector()
+        self.draining: set[socket.socket] = set()
+        self.drain_thread: threading.Thread | None = None
         self.connected_slaves = 0
         self.role = "master" if is_master else "slave"
         self.master_replid = self.id if is_master else "?"
         self.master_repl_offset = 0
+        # how each command from the master is handled, keyed by exact type.
+        # anything else is only executed. built here rather than at module
+        # level since commands is still loading when this module is imported
+        self.master_handlers: dict[type, Callable] = {
+            commands.ReplConfGetAckCommand: self.reply_to_master,
+        }
         # attempt to connect to master
         if not is_master:
             threading.Thread(target=self.connect_to_master, args=(db,)).start()
 
     def connect_to_master(self, db: database.Database):
-        self.master_conn = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        is_unix = self.master_ip == "unix"
+        self.master_conn = socket.socket(
+            socket.AF_UNIX if is_unix else socket.AF_INET, socket.SOCK_STREAM
+        )
         self.master_conn.settimeout(constants.CONN_TIMEOUT)
-        self.master_conn.connect((self.master_ip, int(self.master_port)))
-
-        self.master_conn.sendall(commands.craft_command("PING").encode())
-        data = self.master_conn.recv(constants.BUFFER_SIZE)
-        logger.info(f"Replica sent ping, got {data=}")
-        # check if we get PONG
-        if data != commands.PingCommand(b"").execute(None, None, None):
-            logger.info("Failed to connect to master")
-            return
-
-        self.master_conn.sendall(
-            commands.craft_command(
-                "REPLCONF", "listening-port", str(self.port)
-            ).encode()
+        # replication is lots of small writes, don't let nagle hold them back.
+        # the receive buffer is set before connecting so the window scale
+        # accounts for it
+        if not is_unix:
+            self.master_conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.master_conn.setsockopt(
+            socket.SOL_SOCKET, socket.SO_RCVBUF, constants.REPL_SOCKET_BUFFER_SIZE
         )
-        data = self.master_conn.recv(constants.BUFFER_SIZE)
-        logger.info(f"Replica sent REPLCONF 1, got {data=}")
-        # check if we get OK
-        if data != constants.OK_SIMPLE_RESP_STRING.encode():
-            logger.info("Failed to connect to master")
-            return
+        if is_unix:
+            # --replicaof unix <path>, the port is the socket path
+            master_path = str(self.master_port)
+            self.master_conn.connect(master_path)
+        else:
+            master_addr = (self.master_ip, int(self.master_port))
+            self.master_conn.connect(master_addr)
 
+        # send the whole handshake at once and check the replies after, rather
+        # than waiting a round trip for each step
+        port = str(self.port).encode()
+        replid = self.master_replid.encode()
         self.master_conn.sendall(
-            commands.craft_command("REPLCONF", "capa", "psync2").encode()
+            b"".join(
+                (
+                    _HANDSHAKE_PING,
+                    _HANDSHAKE_LISTENING_PORT % (len(port), port),
+                    _HANDSHAKE_CAPA,
+                    _HANDSHAKE_PSYNC % (len(replid), replid),
+                )
+            )
         )
-        data = self.master_conn.recv(constants.BUFFER_SIZE)
-        logger.info(f"Replica sent REPLCONF 2, got {data=}")
-        # check if we get OK
-        if data != constants.OK_SIMPLE_RESP_STRING.encode():
-            logger.info("Failed to connect to master")
-            return
+        buf = bytearray()
+        for step, expected in (
+            ("PING", replies.PONG),
+            ("REPLCONF 1", replies.OK),
+            ("REPLCONF 2", replies.OK),
+        ):
+            data = self.read_reply(buf)
+            logger.info("Replica sent %s, got data=%r", step, data)
+            if data != expected:
+                logger.info("Failed to connect to master")
+                return
+        logger.info("Replica sent PSYNC")
 
-        self.master_conn.sendall(
-            commands.craft_command("PSYNC", self.master_replid, str(-1)).encode()
+        # read FULLRESYNC and the whole RDB before parsing, the RDB is usually
+        # bigger than a single recv
+        fullresync = self.read_reply(buf)
+        rdb_header = self.read_reply(buf)
+        if not fullresync.startswith(b"+FULLRESYNC") or not rdb_header.startswith(b"$"):
+            logger.info("Failed to connect to master, got %r", fullresync)
+            return
+        # the length is known up front, so receive straight into a buffer of
+        # that size instead of growing one a BUFFER_SIZE chunk at a time
+        rdb_len = int(rdb_header[1:-2])
+        rdb_buf = bytearray(rdb_len)
+        got = min(len(buf), rdb_len)
+        rdb_buf[:got] = buf[:got]
+        del buf[:got]
+        with memoryview(rdb_buf) as rdb_view:
+            while got < rdb_len:
+                n = self.master_conn.recv_into(rdb_view[got:])
+                if not n:
+                    logger.info("Master closed the connection during full sync")
+                    return
+                got += n
+        # both are already framed, so build their commands directly rather than
+        # joining the snapshot back together to parse it again. the RDB is
+        # parsed straight out of rdb_buf
+        handshake_step = self.handle_master_data(
+            [
+                commands.FullResyncCommand(fullresync[1:-2]),
+                commands.RdbFileCommand(rdb_buf),
+            ],
+            db,
+            0,
         )
-        logger.info(f"Replica sent PSYNC")
-        handshake_step = 0
-
+        # a recv can end partway through a command, the parser keeps the
+        # incomplete tail until the rest arrives
+        parser = codec.StreamParser()
+        # anything the master propagated right after the snapshot
+        handshake_step = self.handle_master_data(parser.feed(buf), db, handshake_step)
+        # receive into one buffer, the parser copies complete frames out of it.
+        # the buffer is bigger than a client's so a burst of propagated writes
+        # is taken in one recv rather than one per BUFFER_SIZE
+        recv_buf = bytearray(constants.REPL_RECV_BUFFER_SIZE)
+        recv_view = memoryview(recv_buf)
         while True:
             logger.info("Replica waiting for master...")
-            data = self.master_conn.recv(constants.BUFFER_SIZE)
-            logger.info(f"Replica from master: raw {data=}")
-            if not data:
+            n = self.master_conn.recv_into(recv_buf)
+            if not n:
                 logger.info("Replica breaking")
                 break
+            logger.info("Replica from master: %d bytes", n)
+            handshake_step = self.handle_master_data(
+                parser.feed(recv_view[:n]), db, handshake_step
+            )
 
-            cmds = codec.parse_cmd(data)
-            logger.info(f"Replica {cmds=}")
-            for cmd in cmds:
-                self.respond_to_master(cmd, db)
-                if handshake_step != 2:
-                    handshake_step = self.handle_handshake_psync(handshake_step, cmd)
-                else:
-                    # need to update offset based on cmd in list, not based on full data
-                    self.master_repl_offset += len(cmd.raw_cmd)
+    def read_reply(self, buf: bytearray) -> bytes:
+        # reads one single line reply, anything received after it stays in buf
+        while True:
+            end = buf.find(b"\r\n")
+            if end != -1:
+                break
+            data = self.master_conn.recv(constants.BUFFER_SIZE)
+            if not data:
+                # closed, return what we have so the caller fails the check
+                return bytes(buf)
+            buf += data
+        reply = bytes(buf[: end + 2])
+        del buf[: end + 2]
+        return reply
+
+    def handle_master_data(
+        self, cmds: list["commands.Command"], db: database.Database, handshake_step: int
+    ) -> int:
+        if not cmds:
+            return handshake_step
+        logger.info("Replica cmds=%r", cmds)
+        for cmd in cmds:
+            self.respond_to_master(cmd, db)
+            if handshake_step != 2:
+                handshake_step = self.handle_handshake_psync(handshake_step, cmd)
+            else:
+                # need to update offset based on cmd in list, not based on full data
+                self.master_repl_offset += len(cmd.raw_cmd)
+        self.flush_replicas()
+        return handshake_step
 
     def handle_handshake_psync(
         self, handshake_step: int, cmd: "commands.Command"
@@ -110,34 +243,188 @@ class ReplicaHandler(metaclass=singleton_meta.SingletonMeta):
             return handshake_step
 
     def respond_to_master(self, cmd: "commands.Command", db: database.Database):
+        self.master_handlers.get(type(cmd), self.execute_from_master)(cmd, db)
+
+    def execute_from_master(self, cmd: "commands.Command", db: database.Database):
+        # writes are applied silently, the master doesn't read replies
+        cmd.execute(db, self, self.master_conn)
+
+    def reply_to_master(self, cmd: "commands.Command", db: database.Database):
         executed = cmd.execute(db, self, self.master_conn)
-        if isinstance(cmd, commands.ReplConfGetAckCommand):
-            if isinstance(executed, bytes):  # impossible to get list here
-                self.master_conn.sendall(executed)
+        if isinstance(executed, bytes):  # impossible to get list here
+            self.master_conn.sendall(executed)
 
-    def add_slave(self, slave: socket.socket):
-        self.slaves.append(slave)
-        self.connected_slaves += 1
+    def add_slave(self, slave: socket.socket, fullresync: bytes, rdb_path: str):
+        # writes are queued for the slave from here on, but it's only marked
+        # ready to be flushed once the full sync thread has sent the snapshot,
+        # so nothing can be written into the middle of it
+        # slaves on a unix socket have no nagle to turn off
+        if slave.family != getattr(socket, "AF_UNIX", None):
+            slave.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        slave.setsockopt(
+            socket.SOL_SOCKET, socket.SO_SNDBUF, constants.REPL_SOCKET_BUFFER_SIZE
+        )
+        with self.pending_lock:
+            self.slaves += (slave,)
+            self.slave_offsets.append(self.backlog_start + len(self.backlog))
+            self.slave_ready.append(False)
+            self.connected_slaves += 1
+        threading.Thread(
+            target=self.full_sync, args=(slave, fullresync, rdb_path), daemon=True
+        ).start()
 
-    def propogate(self, raw_cmd: bytes):
-        for slave in self.slaves:
-            slave.sendall(raw_cmd)
+    def full_sync(self, slave: socket.socket, fullresync: bytes, rdb_path: str):
+        # runs on its own thread so a big RDB doesn't hold up the slave's
+        # connection thread
+        try:
+            slave.sendall(fullresync)
+            if os.path.exists(rdb_path) and os.path.getsize(rdb_path) > 0:
+                self.send_rdb(slave, rdb_path)
+            else:
+                slave.sendall(_EMPTY_RDB_RESP)
+        except OSError:
+            logger.exception("Full sync to slave failed")
+            with self.pending_lock:
+                self.remove_slave(slave)
+            return
+        with self.pending_lock:
+            if slave not in self.slaves:
+                return
+            self.slave_ready[self.slaves.index(slave)] = True
+        # send whatever was propagated during the sync
+        self.flush_replicas()
+
+    def send_rdb(self, slave: socket.socket, path: str):
+        # sends the dump as an RDB payload, a bulk string without the trailing
+        # \r\n. socket.sendfile uses os.sendfile where it can so the file is
+        # copied in the kernel, and falls back to plain sends elsewhere
+        with open(path, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            slave.sendall(b"$%d\r\n" % size)
+            slave.sendfile(f, 0, size)
+
+    def propogate(self, raw_cmd: bytes | memoryview):
+        with self.pending_lock:
+            # includes slaves still being synced
+            if self.slaves:
+                self.backlog += raw_cmd
+                self.propagated += 1
+
+    def flush_replicas(self):
+        if not self.slaves:
+            return
+        with self.pending_lock:
+            ready = self.slave_ready
+            dead: list[socket.socket] = []
+            for i, slave in enumerate(self.slaves):
+                # slaves being drained get new writes from the drain thread
+                if not ready[i] or slave in self.draining:
+                    continue
+                try:
+                    if not self.send_pending(i):
+                        continue
+                except (OSError, ValueError):
+                    # disconnected, the caller's own connection is fine
+                    dead.append(slave)
+                    continue
+                self.draining.add(slave)
+                self.write_sel.register(slave, selectors.EVENT_WRITE)
+                if self.drain_thread is None:
+                    self.drain_thread = threading.Thread(target=self.drain, daemon=True)
+                    self.drain_thread.start()
+            for slave in dead:
+                self.remove_slave(slave)
+            self.trim_backlog()
+
+    def send_pending(self, i: int) -> bool:
+        # caller holds pending_lock. returns whether anything is left to send
+        slave = self.slaves[i]
+        offset = self.slave_offsets[i] - self.backlog_start
+        if offset == len(self.backlog):
+            return False
+        # views have to be released before the backlog can be resized
+        with memoryview(self.backlog) as view, view[offset:] as tail:
+            if _SEND_NOWAIT is None:
+                # sendall retries short writes itself
+                slave.sendall(tail)
+                sent = len(tail)
+            else:
+                # try the write first, the buffer almost always has room so the
+                # selector is only needed when it doesn't
+                try:
+                    sent = slave.send(tail, _SEND_NOWAIT)
+                except BlockingIOError:
+                    sent = 0
+        self.slave_offsets[i] += sent
+        return offset + sent < len(self.backlog)
+
+    def remove_slave(self, slave: socket.socket):
+        # caller holds pending_lock. forgets a slave whose connection failed so
+        # the backlog isn't held back for it
+        if slave not in self.slaves:
+            return
+        logger.info("Dropping disconnected slave")
+        i = self.slaves.index(slave)
+        self.slaves = self.slaves[:i] + self.slaves[i + 1 :]
+        del self.slave_offsets[i], self.slave_ready[i]
+        if slave in self.draining:
+            self.draining.discard(slave)
+            try:
+                self.write_sel.unregister(slave)
+            except (KeyError, ValueError):
+                pass
+        self.connected_slaves -= 1
+        self.trim_backlog()
+
+    def trim_backlog(self):
+        # caller holds pending_lock
+        if not self.slave_offsets:
+            self.backlog.clear()
+            return
+        low = min(self.slave_offsets)
+        if low > self.backlog_start:
+            del self.backlog[: low - self.backlog_start]
+            self.backlog_start = low
+
+    def drain(self):
+        # sends the tails left by short writes, exits once every slave is drained
+        try:
+            while True:
+                with self.pending_lock:
+                    # a closed socket drops out of the selector without ever
+                    # becoming writable
+                    for slave in [s for s in self.draining if s.fileno() == -1]:
+                        self.remove_slave(slave)
+                    if not self.draining:
+                        self.drain_thread = None
+                        return
+                for key, _ in self.write_sel.select(0.5):
+                    slave = key.fileobj
+                    with self.pending_lock:
+                        if slave not in self.draining:
+                            continue
+                        try:
+                            if not self.send_pending(self.slaves.index(slave)):
+                                self.draining.discard(slave)
+                                self.write_sel.unregister(slave)
+                        except (OSError, ValueError):
+                            self.remove_slave(slave)
+                        self.trim_backlog()
+        finally:
+            # lets flush_replicas start a new one if this one died
+            with self.pending_lock:
+                if self.drain_thread is threading.current_thread():
+                    self.drain_thread = None
 
     def get_info(self) -> bytes:
-        # encode each kv as a RespBulkString
-        info = {
-            "role": self.role,
-            "connected_slaves": self.connected_slaves,
-            "master_replid": self.master_replid,
-            "master_repl_offset": self.master_repl_offset,
-        }
-        return data_types.RespBulkString(
-            b"".join(
-                map(
-                    lambda item: data_types.RespBulkString(
-                        f"{item[0]}:{item[1]}".encode()
-                    ).encode(),
-                    info.items(),
-                )
-            )
-        ).encode()
+        # a bulk string of bulk strings, one per kv, written into one buffer
+        # instead of encoding a RespBulkString for each
+        buf = bytearray()
+        for field in (
+            b"role:%b" % self.role.encode(),
+            b"connected_slaves:%d" % self.connected_slaves,
+            b"master_replid:%b" % self.master_replid.encode(),
+            b"master_repl_offset:%d" % self.master_repl_offset,
+        ):
+            buf += b"$%d\r\n%b\r\n" % (len(field), field)
+        return b"$%d\r\n%b\r\n" % (len(buf), bytes(buf))
@@ -0,0 +1,26 @@
+import constants
+import data_types
+
+# pre-encoded replies for the common response shapes, so commands can return
+# bytes directly instead of building and encoding a RespDataType
+OK = constants.OK_SIMPLE_RESP_STRING.encode()
+PONG = b"+PONG\r\n"
+NULL_BULK = constants.NULL_BULK_RESP_STRING.encode()
+EMPTY_ARRAY = b"*0\r\n"
+NOOP_ERR = b"-" + constants.NO_OP_RESPONSE.encode() + b"\r\n"
+TYPE_REPLIES = {
+    "string": b"+string\r\n",
+    "stream": b"+stream\r\n",
+    "none": b"+none\r\n",
+}
+
+
+def simple(data: bytes) -> bytes:
+    return b"".join((b"+", data, b"\r\n"))
+
+
+def bulk(data: bytes) -> bytes:
+    # empty data is a null bulk string, same as RespBulkString
+    if not data:
+        return NULL_BULK
+    return b"".join((b"$", data_types.itob(len(data)), b"\r\n", data, b"\r\n"))